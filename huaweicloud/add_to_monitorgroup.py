@@ -1,35 +1,82 @@
 # coding: utf-8
 
-from huaweicloudsdkcore.auth.credentials import BasicCredentials, GlobalCredentials
-from huaweicloudsdkrms.v1.region.rms_region import RmsRegion
+import lazy_sdk
+
+lazy_sdk.install("huaweicloudsdkces.v1", "huaweicloudsdkces.v2", "huaweicloudsdkrms.v1")
 
-from huaweicloudsdkces.v1.region.ces_region import CesRegion
 from huaweicloudsdkcore.exceptions import exceptions
-from huaweicloudsdkces.v1 import *
-from huaweicloudsdkrms.v1 import *
+from huaweicloudsdkces.v1 import ListResourceGroupRequest, ShowResourceGroupRequest, UpdateResourceGroupRequest, \
+    UpdateResourceGroupRequestBody, CreateResourceGroup, MetricsDimension
+from huaweicloudsdkces.v2 import BatchCreateResourcesRequest, BatchDeleteResourcesRequest, AddResourcesReq, \
+    DelResourcesReq, Resource, ResourceDimension
+
+from clients import ClientRegistry
+from inventory import RmsInventory, INVENTORY_TTL
+from graph import InventoryGraph
+from token_cache import TokenCache
+from throttle import backoff
 
 import requests
+import re
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+CES_PAGE_LIMIT = 100  # ShowResourceGroup每页最多100
+CES_BATCH_RESOURCES = 1000  # 监控组批量添加/删除资源每次最多1000个
+GROUP_WORKERS = 8  # 同时同步的监控组数
+
+MOUNT_POINT_PAGE_LIMIT = 1000  # 挂载点每页数量
+MOUNT_POINT_WORKERS = 8  # 挂载点并发拉取的页数
+MOUNT_POINT_TIMEOUT = (10, 60)  # (连接超时, 读超时)秒
+MOUNT_POINT_RETRIES = 3  # 单页失败的重试次数
+MOUNT_POINT_FILTER = ["var", "run", "iso", "pods", "docker", "cd1", "dm"]  # 过滤名称包含这些的挂载点，可自定义。
+
+_tokens = TokenCache()
+_mount_point_filter = re.compile("|".join(re.escape(i) for i in MOUNT_POINT_FILTER))
+
+# 连接池复用TLS连接，大小与并发页数一致
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=MOUNT_POINT_WORKERS))
+
+
+def member_key(namespace, dimensions) -> tuple:
+    """
+    监控组中一个资源的唯一标识，维度按名称排序，与接口返回的顺序无关
+    :param namespace: 如SYS.ECS
+    :param dimensions: [(name, value)]
+    :return: (namespace, ((name, value), ...))
+    """
+    return namespace, tuple(sorted(dimensions))
+
+
+def resource_dimensions(dimension_name, value) -> list:
+    """
+    :param dimension_name: 维度名称，为None时是挂载点
+    :param value: 资源id，挂载点为{"instance_id": ..., "mount_point": ...}
+    :return: [(name, value)]
+    """
+    if dimension_name:
+        return [(dimension_name, value)]
+    return [("instance_id", value.get("instance_id")), ("mount_point", value.get("mount_point"))]
 
 
 class HuaweiCloud:
-    def __init__(self, ak, sk, region):
+    def __init__(self, ak, sk, region, inventory_ttl=INVENTORY_TTL):
         self.ak = ak
         self.sk = sk
         self.region = region
-        self.basic_credentials = BasicCredentials(ak, sk)
-        self.global_credentials = GlobalCredentials(ak, sk)
+        self.clients = ClientRegistry(ak, sk)
 
-        self.ces_client = CesClient.new_builder() \
-            .with_credentials(self.basic_credentials) \
-            .with_region(CesRegion.value_of(self.region)) \
-            .build()
+        self.ces_client = self.clients.get("ces", self.region)
+        self.ces_v2_client = self.clients.get("ces_v2", self.region)
 
         # 此处目前只能填cn-north-4
-        self.rms_client = RmsClient.new_builder() \
-            .with_credentials(self.global_credentials) \
-            .with_region(RmsRegion.value_of("cn-north-4")) \
-            .build()
+        self.rms_client = self.clients.get("rms", "cn-north-4")
+        self.inventory = RmsInventory(self.rms_client, ak, inventory_ttl)
+        self.graph = InventoryGraph()
+        self._graph_lock = threading.Lock()
 
 		 # 需提前在CES控制台创建示例的组如all_ecs
         self.resource_type = {
@@ -59,22 +106,27 @@ class HuaweiCloud:
             print(e.error_code)
             print(e.error_msg)
 
-    def show_resource_group(self, group_id) -> list:
+    def show_resource_group(self, group_id) -> set:
         """
-        查询具体的组的资源
+        查询具体的组的全部资源，按页拉取
         :param group_id: 组id
-        :return: 资源id列表
+        :return: {member_key}，查询失败返回None
         """
-        data = []
+        data = set()
         try:
             request = ShowResourceGroupRequest()
             request.group_id = group_id
-            response = self.ces_client.show_resource_group(request).to_dict()
-            if response:
-                for d in response.get("resources"):
-                    resource_id = d.get("dimensions")[0].get("value")
-                    data.append(resource_id)
-            return data
+            request.limit = str(CES_PAGE_LIMIT)
+            start = 0
+            while True:
+                request.start = str(start)
+                resources = self.ces_client.show_resource_group(request).to_dict().get("resources") or []
+                for d in resources:
+                    dimensions = [(i.get("name"), i.get("value")) for i in d.get("dimensions") or []]
+                    data.add(member_key(d.get("namespace"), dimensions))
+                if len(resources) < CES_PAGE_LIMIT:
+                    return data
+                start += CES_PAGE_LIMIT
         except exceptions.ClientRequestException as e:
             print(e.status_code)
             print(e.error_code)
@@ -86,36 +138,16 @@ class HuaweiCloud:
         :param resource_type: 资源类型，如ecs.cloudservers evs.volumes
         :return: 资源id列表
         """
-        marker = None
-        data = []
-        request = ListAllResourcesRequest()
-        request.limit = 200  # 目前最大200
-        request.type = resource_type
-        while True:
-            try:
-                request.marker = marker
-                request.region_id = self.region  # ces有region区分。
-                response = self.rms_client.list_all_resources(request).to_dict()
-                if response:
-                    page_info = response.get("page_info")
-                    next_marker = page_info.get("next_marker")
-                    # [5f26b1232-6589-4a7b-83f9-1848c547d585-vdb, 2222222-6589-4a7b-83f9-1848c547d585-vda]
-                    # 硬盘监控组比较特殊，id为ecs id + 挂载点
-                    resource_id = [i.get("properties").get("attachments")[0].get("serverId") + "-" +
-                                   i.get("properties").get("attachments")[0].get("device")[-3:]
-                                   if resource_type == "evs.volumes" else i.get("id")
-                                   for i in response.get("resources")]
-                    data.extend(resource_id)
-                    if next_marker:
-                        marker = next_marker
-                    else:
-                        return data
-                else:
-                    return data
-            except exceptions.ClientRequestException as e:
-                print(e.status_code)
-                print(e.error_code)
-                print(e.error_msg)
+        self.inventory.list_resources(resource_type)  # 多个组同一类型时只拉取一次，其他组等待后读缓存
+        with self._graph_lock:
+            if not self.graph.all(resource_type):
+                self.graph.load(self.inventory, [resource_type])
+        resources = self.graph.in_region(resource_type, self.region)  # ces有region区分。
+        # [5f26b1232-6589-4a7b-83f9-1848c547d585-vdb, 2222222-6589-4a7b-83f9-1848c547d585-vda]
+        # 硬盘监控组比较特殊，id为ecs id + 挂载点
+        if resource_type == "evs.volumes":
+            return [i.server_id + "-" + i.device[-3:] for i in resources if i.server_id]
+        return [i.id for i in resources]
 
     def update_resource_groups(self, group_name, group_id, namespace, dimension_name, resources_id: list):
         """
@@ -167,17 +199,72 @@ class HuaweiCloud:
             print(e.error_code)
             print(e.error_msg)
 
+    def sync_resource_group(self, group_name, group_id, namespace, dimension_name, resources_id: list):
+        """
+        增量同步监控组：对比组中现有的资源，只添加缺少的、删除多余的，没有变化的组不调用修改接口。
+        无法查询现有资源或批量接口失败时，退回到全量更新update_resource_groups
+        :param group_name: 监控组名称
+        :param group_id: 监控组id
+        :param namespace: 如SYS.ECS
+        :param dimension_name: 如instance_id，挂载点为None
+        :param resources_id: 资源id，挂载点为get_mount_point的结果
+        :return:
+        """
+        desired = {member_key(namespace, resource_dimensions(dimension_name, i)) for i in resources_id}
+        current = self.show_resource_group(group_id)
+        if current is None:
+            return self.update_resource_groups(group_name, group_id, namespace, dimension_name, resources_id)
+        add = sorted(desired - current)
+        remove = sorted(current - desired)
+        if not add and not remove:
+            print(f"{group_name}: 无变化，共{len(current)}个资源")
+            return
+        print(f"{group_name}: 新增{len(add)}个，移除{len(remove)}个")
+        try:
+            for i in range(0, len(add), CES_BATCH_RESOURCES):
+                request = BatchCreateResourcesRequest()
+                request.group_id = group_id
+                request.body = AddResourcesReq(resources=self._to_resources(add[i:i + CES_BATCH_RESOURCES]))
+                self.ces_v2_client.batch_create_resources(request)
+            for i in range(0, len(remove), CES_BATCH_RESOURCES):
+                request = BatchDeleteResourcesRequest()
+                request.group_id = group_id
+                request.body = DelResourcesReq(resources=self._to_resources(remove[i:i + CES_BATCH_RESOURCES]))
+                self.ces_v2_client.batch_delete_resources(request)
+        except exceptions.ClientRequestException as e:
+            print(e.status_code)
+            print(e.error_code)
+            print(e.error_msg)
+            self.update_resource_groups(group_name, group_id, namespace, dimension_name, resources_id)
+
+    @staticmethod
+    def _to_resources(members) -> list:
+        return [Resource(namespace=namespace, dimensions=[ResourceDimension(name=k, value=v) for k, v in dimensions])
+                for namespace, dimensions in members]
+
 
 def get_token(region, domain_name, username, password) -> str:
     """
-    获取华为云token，需提前创建iam用户并授权CES权限
+    获取华为云token，需提前创建iam用户并授权CES权限。token缓存到过期前，期间不再调用IAM
     :param region: region
     :param domain_name: iam账户名
     :param username: 用户名
     :param password:密码
     :return:
     """
-    region = region
+    return _tokens.get((domain_name or "", username or "", region),
+                       lambda: request_token(region, domain_name, username, password))
+
+
+def request_token(region, domain_name, username, password) -> tuple:
+    """
+    通过IAM用户密码认证获取token
+    :param region: region
+    :param domain_name: iam账户名
+    :param username: 用户名
+    :param password:密码
+    :return: (token, expires_at)，失败返回(None, None)
+    """
     iam_url = "https://iam.cn-southwest-2.myhuaweicloud.com/v3/auth/tokens"
     headers = {'Content-Type': 'application/json'}
     data = {
@@ -206,66 +293,105 @@ def get_token(region, domain_name, username, password) -> str:
     try:
         response = requests.post(url=iam_url, data=json.dumps(data), headers=headers)
         token = response.headers.get("X-Subject-Token")
-        return token
+        expires_at = (response.json().get("token") or {}).get("expires_at") if token else None
+        return token, expires_at
     except Exception as e:
         print(e)
+    return None, None
 
 
-def get_mount_point(token) -> list:
+def get_mount_point_page(token, start) -> dict:
     """
-    获取已筛选的挂载点，返回list类型的id
+    获取一页挂载点，失败时按退避重试
     :param token: 华为云token
-    :return: mountpoint list
+    :param start: 分页起始值
+    :return: 接口返回的json，重试后仍失败返回None
     """
-    data = []
     region_id = "09d72227ab8025212ffcc0080c1cc471"  # 华为云企业项目id，自行查询对应的区域的id
     region = "cn-southwest-2"  # 企业项目
     url = f"https://console.huaweicloud.com/ces/rest/V1.0/ecs/{region_id}/instances"
-    namespace = "AGT.ECS" # 使用agent方式的namespace会更准确。需给所有ECS安装上监控agent
-    start = 0
-    limit = 1000
-    dim_name = "mount_point"
     headers = {
         "x-auth-token": token,
         "region": region,
         "projectname": region
     }
-
-    mount_point_filter = ["var", "run", "iso", "pods", "docker","cd1","dm"]  # 过滤这些挂载点，可自定义。
-
-    while True:
-        params = {
-            "namespace": namespace,
-            "start": start,
-            "limit": limit,
-            "dim.0.name": dim_name
-        }
+    params = {
+        "namespace": "AGT.ECS",  # 使用agent方式的namespace会更准确。需给所有ECS安装上监控agent
+        "start": start,
+        "limit": MOUNT_POINT_PAGE_LIMIT,
+        "dim.0.name": "mount_point"
+    }
+    for attempt in range(MOUNT_POINT_RETRIES + 1):
         try:
             # https://console.huaweicloud.com/ces/rest/V1.0/ecs/09d72227ab8025212ffcc0080c1cc471/instances?namespace=AGT.ECS&start=0&limit=1000&dim.0.name=mount_point
-            res = requests.get(url=url, params=params, headers=headers)
-            res_json = json.loads(res.content.decode("utf-8"))
-            total = res_json.get("total")
-            instances = res_json.get("instances")
-            for i in instances:
-                name = i.get("name")
-                is_filter = [False if i in name else True for i in mount_point_filter]
-                if all(is_filter):
-                    tmp = {
-                        "instance_id": i.get("instance_id"),
-                        "mount_point": i.get("mount_point"),
-                        "name": name
-                    }
-                    data.append(tmp)
+            res = _session.get(url=url, params=params, headers=headers, timeout=MOUNT_POINT_TIMEOUT)
+            res.raise_for_status()
+            return res.json()
+        except (requests.RequestException, ValueError) as e:
+            print(e)
+        if attempt < MOUNT_POINT_RETRIES:
+            time.sleep(backoff(attempt + 1))
+    return None
 
-            start += 1000
-            if start > total:
-                break
 
-        except Exception as e:
-            print(e)
+def get_mount_point(token) -> list:
+    """
+    获取已筛选的挂载点。先拉取第一页得到total，其余页并发拉取
+    :param token: 华为云token
+    :return: mountpoint list，有任意一页拉取失败时返回None，避免按不完整的列表移除监控组中的资源
+    """
+    first = get_mount_point_page(token, 0)
+    if first is None:
+        return None
+    total = first.get("total") or 0
+    starts = range(MOUNT_POINT_PAGE_LIMIT, total, MOUNT_POINT_PAGE_LIMIT)
+    with ThreadPoolExecutor(max_workers=MOUNT_POINT_WORKERS) as executor:
+        pages = [first] + list(executor.map(lambda start: get_mount_point_page(token, start), starts))
+    if None in pages:
+        print("挂载点拉取失败")
+        return None
+
+    data = []
+    for page in pages:
+        for i in page.get("instances") or []:
+            name = i.get("name")
+            if not _mount_point_filter.search(name or ""):
+                data.append({
+                    "instance_id": i.get("instance_id"),
+                    "mount_point": i.get("mount_point"),
+                    "name": name
+                })
     return data
 
 
+def sync_group(huaweicloud, group_name, group_id, iam_name, username, password):
+    """
+    同步一个监控组
+    :param huaweicloud: HuaweiCloud
+    :param group_name: 监控组名称
+    :param group_id: 监控组id
+    :param iam_name: iam账户名，挂载点组获取token使用
+    :param username: iam用户名
+    :param password: iam用户密码
+    :return:
+    """
+    # 挂载点
+    if group_name == "all_mountpoint":
+        token = get_token(huaweicloud.region, iam_name, username, password)
+        mount_point_data = get_mount_point(token)
+        if mount_point_data is None:
+            return
+        huaweicloud.sync_resource_group(group_name, group_id, "SYS.ECS", None, mount_point_data)
+    else:
+        r_type = huaweicloud.resource_type.get(group_name)
+        if r_type:
+            resource_type = r_type.get("type")
+            namespace = r_type.get("namespace")
+            dimension_name = r_type.get("dimension_name")
+            resources_id = huaweicloud.get_all_resources(resource_type)
+            huaweicloud.sync_resource_group(group_name, group_id, namespace, dimension_name, resources_id)
+
+
 def handler(event, context):
     ak = context.getAccessKey()
     sk = context.getSecretKey()
@@ -273,25 +399,14 @@ def handler(event, context):
     iam_name = context.getUserData("iam_name")
     username = context.getUserData("hw_iam_username")
     password = context.getUserData("hw_iam_password")
-    huaweicloud = HuaweiCloud(ak, sk, region)
-    groups = huaweicloud.list_resource_group()
-
-    for group_name, group_id in groups.items():
-        # 过滤default组
-        if group_name != "default":
-
-            # 挂载点
-            if group_name == "all_mountpoint":
-                token = get_token(region, iam_name, username, password)
-                mount_point_data = get_mount_point(token)
-                huaweicloud.update_resource_groups(group_name, group_id, "SYS.ECS", None, mount_point_data)
-            else:
-                # group_resources = huaweicloud.show_resource_group(group_id)
-                r_type = huaweicloud.resource_type.get(group_name)
-                if r_type:
-                    resource_type = r_type.get("type")
-                    namespace = huaweicloud.resource_type.get(group_name).get("namespace")
-                    dimension_name = huaweicloud.resource_type.get(group_name).get("dimension_name")
-                    resources_id = huaweicloud.get_all_resources(resource_type)
-                    # print(namespace, dimension_name, group_id, group_name)
-                    huaweicloud.update_resource_groups(group_name, group_id, namespace, dimension_name, resources_id)
+    inventory_ttl = int(context.getUserData("inventory_ttl") or INVENTORY_TTL)
+    huaweicloud = HuaweiCloud(ak, sk, region, inventory_ttl)
+    groups = huaweicloud.list_resource_group() or {}
+    groups = {k: v for k, v in groups.items() if k != "default"}  # 过滤default组
+
+    # 各组同时同步，总耗时为最慢的一个组；资源类型相同的组共用一次RMS拉取
+    with ThreadPoolExecutor(max_workers=min(GROUP_WORKERS, len(groups)) or 1) as executor:
+        futures = [executor.submit(sync_group, huaweicloud, group_name, group_id, iam_name, username, password)
+                   for group_name, group_id in groups.items()]
+    for future in futures:
+        future.result()
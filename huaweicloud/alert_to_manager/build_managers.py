@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+
+try:
+    import lazy_sdk  # 与huaweicloud目录下的公共模块一起打包时按需导入
+
+    lazy_sdk.install("huaweicloudsdkrms.v1")
+except ImportError:
+    pass  # 未打包lazy_sdk.py时全量导入SDK
+
+from huaweicloudsdkcore.auth.credentials import GlobalCredentials
+from huaweicloudsdkcore.exceptions import exceptions
+from huaweicloudsdkrms.v1.region.rms_region import RmsRegion
+from huaweicloudsdkrms.v1 import RmsClient, ListAllTagsRequest
+
+from utils import hanzi2pinyin, load_json, MANAGERS_FILE, MANAGERS_OVERRIDE_FILE
+
+import os
+import json
+import argparse
+
+"""
+生成负责人 => 邮箱的目录，打包上传函数前执行：
+python build_managers.py --ak xxx --sk xxx --domain your_domain.com
+通过RMS列出账号下所有资源的负责人标签值，按拼音生成邮箱，managers_override.json中的负责人以覆盖表为准。
+拼音相同的负责人会打印出来，需在覆盖表中指定各自的邮箱。新增负责人后需重新执行
+"""
+
+MANAGER_TAG = "负责人"
+RMS_PAGE_LIMIT = 200
+
+
+def list_tag_values(rms_client, key) -> list:
+    """
+    获取账号下所有资源某个标签键的全部值
+    @param rms_client: rms client
+    @param key: 标签键
+    @return: [标签值]
+    """
+    values = []
+    request = ListAllTagsRequest()
+    request.key = key
+    request.limit = RMS_PAGE_LIMIT
+    while True:
+        response = rms_client.list_all_tags(request).to_dict()
+        for tag in response.get("tags") or []:
+            if tag.get("key") == key:
+                values.extend(tag.get("value") or [])
+        marker = (response.get("page_info") or {}).get("next_marker")
+        if not marker:
+            return values
+        request.marker = marker
+
+
+def build(managers, domain, overrides) -> dict:
+    """
+    生成目录，并打印拼音相同、未在覆盖表中指定邮箱的负责人
+    @param managers: 负责人列表
+    @param domain: 邮箱域名
+    @param overrides: 覆盖表 {"负责人": "邮箱"}
+    @return: {"负责人": "邮箱"}
+    """
+    directory = {}
+    for manager in sorted(set(managers)):
+        directory[manager] = overrides.get(manager) or hanzi2pinyin(manager) + "@" + domain
+
+    owners = {}
+    for manager, email in directory.items():
+        owners.setdefault(email, []).append(manager)
+    for email, names in owners.items():
+        names = [i for i in names if i not in overrides]
+        if len(owners[email]) > 1 and names:
+            print(f"邮箱重复 {email}: {'、'.join(owners[email])}，请在{os.path.basename(MANAGERS_OVERRIDE_FILE)}中指定")
+    return directory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="生成负责人 => 邮箱的目录")
+    parser.add_argument("--ak", default=os.environ.get("HUAWEICLOUD_SDK_AK"))
+    parser.add_argument("--sk", default=os.environ.get("HUAWEICLOUD_SDK_SK"))
+    parser.add_argument("--domain", default="your_domain.com", help="邮箱域名")
+    parser.add_argument("--output", default=MANAGERS_FILE)
+    args = parser.parse_args()
+
+    # 此处目前只能填cn-north-4
+    client = RmsClient.new_builder() \
+        .with_credentials(GlobalCredentials(args.ak, args.sk)) \
+        .with_region(RmsRegion.value_of("cn-north-4")) \
+        .build()
+    try:
+        managers = list_tag_values(client, MANAGER_TAG)
+    except exceptions.ClientRequestException as e:
+        print(e.status_code)
+        print(e.error_code)
+        print(e.error_msg)
+        raise SystemExit(1)
+
+    directory = build(managers, args.domain, load_json(MANAGERS_OVERRIDE_FILE, {}))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(directory, f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"共{len(directory)}个负责人，已写入{args.output}")
@@ -0,0 +1,18 @@
+# -*- coding:utf-8 -*-
+
+import jinja2
+
+from utils import create_template_env, COMPILED_TEMPLATES_PATH, _cur_path
+
+"""
+预编译邮件模板为python模块，打包上传函数前执行：python compile_templates.py
+运行时通过ModuleLoader直接加载，不再解析和编译html模板。修改模板或升级jinja2后需重新执行
+"""
+
+TEMPLATES = ["template.html", "digest.html"]
+
+if __name__ == '__main__':
+    env = create_template_env(jinja2.FileSystemLoader([_cur_path]))
+    env.compile_templates(COMPILED_TEMPLATES_PATH, zip=None, filter_func=lambda name: name in TEMPLATES,
+                          ignore_errors=False)
+    print(f"已编译到{COMPILED_TEMPLATES_PATH}")
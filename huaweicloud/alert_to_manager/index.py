@@ -1,17 +1,46 @@
 # coding: utf-8
 
+try:
+    import lazy_sdk  # 与huaweicloud目录下的公共模块一起打包时按需导入
+
+    lazy_sdk.install("huaweicloudsdkrms.v1")
+except ImportError:
+    pass  # 未打包lazy_sdk.py时全量导入SDK
+
 from huaweicloudsdkcore.auth.credentials import GlobalCredentials
 from huaweicloudsdkcore.exceptions import exceptions
 from huaweicloudsdkrms.v1.region.rms_region import RmsRegion
-from huaweicloudsdkrms.v1 import *
+from huaweicloudsdkrms.v1 import RmsClient, ShowResourceByIdRequest
 
 from utils import *
 import yagmail
-import jinja2
+import smtplib
 import json
 import os
+import time
+import queue
+import threading
+
+# 热启动时复用，避免每条告警都重新创建rms client和jinja环境
+_huaweicloud = None
+_mail = None
+
+# 资源id => 负责人的缓存，同一资源反复告警时不再请求rms
+MANAGER_CACHE_SIZE = 4096
+MANAGER_CACHE_TTL = int(os.environ.get("manager_cache_ttl", 3600))
+MANAGER_CACHE_NEGATIVE_TTL = int(os.environ.get("manager_cache_negative_ttl", 300))  # 没有负责人标签的资源
+MANAGER_CACHE_FILE = os.environ.get("manager_cache_file", "/tmp/alert_to_manager_managers.json")  # 置空则不持久化
+_manager_cache = TTLCache(MANAGER_CACHE_SIZE, MANAGER_CACHE_TTL, MANAGER_CACHE_FILE or None)
 
-_cur_path = os.path.dirname(os.path.realpath(__file__))
+# smtp连接空闲超过该时间(秒)后主动重连，避免使用已被服务端断开的连接
+SMTP_IDLE_TIMEOUT = int(os.environ.get("smtp_idle_timeout", 60))
+SMTP_QUEUE_SIZE = 100  # 待发送邮件队列的最大长度，满了之后提交会阻塞
+
+# 告警汇总模式(环境变量digest_window大于0)下按负责人缓冲告警，窗口结束后合并成一封邮件
+_spool = AlertSpool(os.environ.get("digest_spool_dir", "/tmp/alert_to_manager_spool"))
+
+# 负责人 => 邮箱，读取预先生成的目录，不在目录中的负责人才按拼音生成
+_managers = ManagerDirectory(os.environ.get("mail_domain", "your_domain.com"))
 
 
 class HuaWeiCloud:
@@ -43,6 +72,10 @@ class HuaWeiCloud:
         :param resource_id: 资源id
         :return: 负责人
         """
+        cache_key = f"{resource_provider}.{resource_type}:{resource_id}"
+        manager = _manager_cache.get(cache_key)
+        if manager is not MISSING:
+            return manager or None
         try:
             request = ShowResourceByIdRequest()
             request.provider = resource_provider
@@ -50,6 +83,10 @@ class HuaWeiCloud:
             request.resource_id = resource_id
             response = self.rms_client.show_resource_by_id(request).to_dict()
             manager = response.get("tags").get("负责人") if response else None 
+            if manager:
+                _manager_cache.set(cache_key, manager)
+            else:
+                _manager_cache.set(cache_key, "", MANAGER_CACHE_NEGATIVE_TTL)
             return manager
 
         except exceptions.ClientRequestException as e:
@@ -58,13 +95,112 @@ class HuaWeiCloud:
             print(e.error_msg)
 
 
+class SmtpSender:
+    def __init__(self, user, password, host):
+        """
+        保持一个已登录的smtp连接，同一次调用中的所有邮件通过该连接依次发送，
+        连接断开或空闲超时后才重新登录，调用结束时关闭。
+        邮件放入队列后由后台线程发送
+        @param user: 发送者邮件
+        @param password: 密码
+        @param host: smtp地址
+        """
+        self.user = user
+        self.password = password
+        self.host = host
+        self._yag = None  # 只用于登录和生成邮件内容，发送直接使用其smtp连接
+        self._last_used = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=SMTP_QUEUE_SIZE)
+        self._worker = None
+
+    def _connect(self):
+        if self._yag is not None and time.time() - self._last_used > SMTP_IDLE_TIMEOUT:
+            self._close()
+        if self._yag is None:
+            yag = yagmail.SMTP(user=self.user, password=self.password, host=self.host)
+            yag.login()  # 建立连接并登录，yagmail.SMTP.send每次都会重新登录，因此不使用send
+            self._yag = yag
+        return self._yag
+
+    def _close(self):
+        if self._yag is None:
+            return
+        try:
+            self._yag.close()  # quit，释放连接
+        except Exception as e:
+            print(e)
+        self._yag = None
+
+    def send(self, **kwargs) -> bool:
+        """
+        同步发送，连接断开时重新登录一次
+        @param kwargs: yagmail.SMTP.send的参数(to cc subject contents等)
+        @return: 是否发送成功
+        """
+        with self._lock:
+            for _ in range(2):
+                try:
+                    yag = self._connect()
+                    recipients, message = yag.prepare_send(**kwargs)
+                    yag.smtp.sendmail(yag.user, recipients, message)
+                    self._last_used = time.time()
+                    return True
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    print(e)  # 服务器拒收，连接仍然可用
+                    return False
+                except (smtplib.SMTPServerDisconnected, OSError) as e:  # 连接已断开，重新登录后重试
+                    print(e)
+                    self._close()
+                except Exception as e:
+                    print(e)
+                    return False
+            return False
+
+    def close(self):
+        """
+        关闭连接
+        @return:
+        """
+        with self._lock:
+            self._close()
+
+    def submit(self, **kwargs):
+        """
+        放入发送队列，由后台线程发送
+        @param kwargs: yagmail.SMTP.send的参数
+        @return:
+        """
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+        self._queue.put(kwargs)
+
+    def flush(self):
+        """
+        等待队列中的邮件全部发送完成并关闭连接，函数返回前必须调用，否则实例冻结后邮件不会发出
+        @return:
+        """
+        self._queue.join()
+        self.close()
+
+    def _run(self):
+        while True:
+            kwargs = self._queue.get()
+            try:
+                if self.send(**kwargs):
+                    print("发送邮件成功。")
+            finally:
+                self._queue.task_done()
+
+
 class MyTemplateMail:
     def __init__(self, user, password, host, subject, template_name):
         """
         @param user: 发送者邮件
         @param password: 密码
         @param host: smtp地址
-        @param subject: 邮件标题
+        @param subject: 默认的邮件标题
         @param template: 模板文件名
         """
         self.user = user
@@ -73,41 +209,105 @@ class MyTemplateMail:
         self.subject = subject
         self.template_name = template_name
 
-        self.template_env = jinja2.Environment(
-            undefined=jinja2.StrictUndefined,
-            loader=jinja2.FileSystemLoader([_cur_path])
-        )
+        self.template_env = create_template_env()
+        self.sender = SmtpSender(user, password, host)
 
-    def send_email(self, value, to, cc=None):
+    def send_email(self, value, to, cc=None, subject=None, template_name=None):
         """
         发送邮件
         @param value: 数据
         @param to: 邮件接收者 list
         @param cc: 抄送 list
+        @param subject: 邮件标题，为空时使用默认标题
+        @param template_name: 模板文件名，为空时使用默认模板
         @return:
         """
         try:
-            template = self.template_env.get_template(self.template_name)
-            contents = template.render(**value).replace("\n", "")
-            with yagmail.SMTP(user=self.user, password=self.password, host=self.host) as yag:
-                yag.send(to=to, cc=cc, subject=self.subject, contents=contents)
-                print("发送邮件成功。")
+            template = self.template_env.get_template(template_name or self.template_name)
+            contents = template.render(**value)  # 换行在编译模板时已去掉
+            self.sender.submit(to=to, cc=cc, subject=subject or self.subject, contents=contents)
         except Exception as e:
             print(e)
 
+    def flush(self):
+        """
+        等待所有邮件发送完成
+        @return:
+        """
+        self.sender.flush()
+
+
+def get_huaweicloud(ak, sk) -> HuaWeiCloud:
+    """
+    获取模块级的HuaWeiCloud，ak/sk变化时才重新创建
+    @param ak: access key
+    @param sk: secret key
+    @return: HuaWeiCloud
+    """
+    global _huaweicloud
+    if _huaweicloud is None or _huaweicloud.ak != ak or _huaweicloud.sk != sk:
+        _huaweicloud = HuaWeiCloud(ak, sk)
+    return _huaweicloud
 
-def handler(event, context):
-    ak = context.getAccessKey()
-    sk = context.getSecretKey()
-    message = event['record'][0]['smn']['message']  # 返回的是字符串，并不是dict
-    subject = event['record'][0]['smn']['subject']  # 返回的是字符串，并不是dict
 
+def get_mail(user, password, host, subject) -> MyTemplateMail:
+    """
+    获取模块级的MyTemplateMail，发件账号变化时才重新创建
+    @param user: 发送者邮件
+    @param password: 密码
+    @param host: smtp地址
+    @param subject: 默认的邮件标题
+    @return: MyTemplateMail
+    """
+    global _mail
+    if _mail is None or (_mail.user, _mail.password, _mail.host) != (user, password, host):
+        _mail = MyTemplateMail(user, password, host, subject, "template.html")
+    return _mail
+
+
+def flush_digests(mail, window):
+    """
+    发送已到窗口时间的告警汇总邮件，只有一条告警时按原模板发送
+    @param mail: MyTemplateMail
+    @param window: 窗口时间(秒)，0发送全部
+    @return:
+    """
+    for manager, items in _spool.pop_due(window).items():
+        first = items[0]
+        if len(items) == 1:
+            mail.send_email(first["value"], to=first["to"], cc=first["cc"], subject=first["subject"])
+            continue
+        alerts = [i["value"] for i in items]
+        value = {
+            "manager": manager,
+            "alerts": alerts,
+            "start_time": alerts[0].get("occour_time"),
+            "end_time": alerts[-1].get("occour_time"),
+        }
+        mail.send_email(value, to=first["to"], cc=first["cc"], subject=f"告警汇总：共{len(alerts)}条告警",
+                        template_name="digest.html")
+
+
+def handler(event, context):
     username = context.getUserData("username")
     password = context.getUserData("password")
     cc = context.getUserData("cc") # 抄送
     host = context.getUserData("host")
+    digest_window = int(context.getUserData("digest_window") or 0)  # 告警汇总的窗口时间(秒)，0为每条告警单独发送
+
+    # 定时触发器：发送已到窗口时间的告警汇总
+    if event.get("trigger_type") == "TIMER":
+        mail = get_mail(username, password, host, None)
+        flush_digests(mail, digest_window)
+        mail.flush()
+        return
+
+    ak = context.getAccessKey()
+    sk = context.getSecretKey()
+    message = event['record'][0]['smn']['message']  # 返回的是字符串，并不是dict
+    subject = event['record'][0]['smn']['subject']  # 返回的是字符串，并不是dict
 
-    huaweicloud = HuaWeiCloud(ak, sk)
+    huaweicloud = get_huaweicloud(ak, sk)
 
     message = json.loads(message)
     namespace = message.get("namespace")
@@ -144,9 +344,14 @@ def handler(event, context):
             "occour_data": template_variable.get("DataPoint"),
         }
 
-        mail = MyTemplateMail(username, password, host, subject, "template.html")
-        send_to = hanzi2pinyin(manager) + "@your_domain.com"
+        mail = get_mail(username, password, host, subject)
+        send_to = _managers.email(manager)
         cc_to = [cc]
-        mail.send_email(value, to=send_to, cc=cc_to)
+        if digest_window > 0:
+            _spool.append(manager, {"value": value, "to": send_to, "cc": cc_to, "subject": subject})
+            flush_digests(mail, digest_window)
+        else:
+            mail.send_email(value, to=send_to, cc=cc_to, subject=subject)
+        mail.flush()
     else:
         print("manager 为空。")
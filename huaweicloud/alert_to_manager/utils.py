@@ -1,21 +1,244 @@
 # -*- coding:utf-8 -*-
 
 import os
-from pypinyin import lazy_pinyin
+import json
+import time
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+import jinja2
+import jinja2.ext
 
+# pypinyin导入时读取，必须在导入之前设置
 os.environ['PYPINYIN_NO_PHRASES'] = 'true'  # 禁用内置的词组拼音库，减少内存开销
 os.environ['PYPINYIN_NO_DICT_COPY'] = 'true'  # 禁用默认的“拼音库”copy 操作，减少内存开销
 
+MISSING = object()  # 缓存未命中
 
+_cur_path = os.path.dirname(os.path.realpath(__file__))
+COMPILED_TEMPLATES_PATH = os.path.join(_cur_path, "templates_compiled")  # compile_templates.py的输出目录
+TEMPLATE_BYTECODE_CACHE = "/tmp/alert_to_manager_jinja"
+MANAGERS_FILE = os.path.join(_cur_path, "managers.json")  # build_managers.py生成的负责人 => 邮箱
+MANAGERS_OVERRIDE_FILE = os.path.join(_cur_path, "managers_override.json")  # 手工维护，如重名、拼音不符的负责人
+
+
+@functools.lru_cache(maxsize=1024)
 def hanzi2pinyin(keyword):
     """
-    中文转拼音
+    中文转拼音，pypinyin在第一次调用时才导入，结果缓存
     @param keyword: 中文
     @return:
     """
+    from pypinyin import lazy_pinyin
     result = "".join(lazy_pinyin(keyword)).split()[0]
     return result
 
 
+def load_json(path, default=None):
+    """
+    读取json文件
+    @param path: 文件路径
+    @param default: 文件不存在或格式错误时返回的值
+    @return:
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+class ManagerDirectory:
+    def __init__(self, domain, path=MANAGERS_FILE, override_path=MANAGERS_OVERRIDE_FILE):
+        """
+        负责人 => 邮箱的目录，预先生成的目录和手工维护的覆盖表在加载时合并成一个dict，覆盖表优先。
+        目录中没有的负责人才用拼音生成邮箱，结果同样记入目录
+        @param domain: 邮箱域名，如your_domain.com
+        @param path: build_managers.py生成的目录文件
+        @param override_path: 覆盖表文件，格式同目录文件 {"负责人": "邮箱"}
+        """
+        self.domain = domain
+        self._emails = load_json(path, {})
+        self._emails.update(load_json(override_path, {}))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._emails)
+
+    def email(self, manager) -> str:
+        """
+        获取负责人的邮箱
+        @param manager: 负责人标签的值
+        @return: 邮箱
+        """
+        email = self._emails.get(manager)
+        if email is None:
+            print(f"负责人{manager}不在目录中，按拼音生成邮箱，建议重新执行build_managers.py")
+            email = hanzi2pinyin(manager) + "@" + self.domain
+            with self._lock:
+                self._emails[manager] = email
+        return email
+
+
+class StripNewlinesExtension(jinja2.ext.Extension):
+    """
+    编译模板时去掉模板中的换行，不需要每次渲染后再对整个结果做replace
+    """
+
+    def preprocess(self, source, name, filename=None):
+        return source.replace("\n", "")
+
+
+def _strip_newlines(value):
+    # 变量中的换行同样去掉，与渲染后整体replace的结果一致
+    return value.replace("\n", "") if isinstance(value, str) else value
+
+
+def create_template_env(loader=None) -> jinja2.Environment:
+    """
+    创建邮件模板的jinja环境。compile_templates.py预编译时和运行时必须使用同样的配置
+    @param loader: 为空时优先加载预编译的模板，不存在则读取html并使用/tmp下的字节码缓存
+    @return: jinja2.Environment
+    """
+    bytecode_cache = None
+    if loader is None:
+        if os.path.isdir(COMPILED_TEMPLATES_PATH):
+            loader = jinja2.ModuleLoader(COMPILED_TEMPLATES_PATH)
+        else:
+            loader = jinja2.FileSystemLoader([_cur_path])
+            os.makedirs(TEMPLATE_BYTECODE_CACHE, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(TEMPLATE_BYTECODE_CACHE)
+    return jinja2.Environment(
+        undefined=jinja2.StrictUndefined,
+        loader=loader,
+        bytecode_cache=bytecode_cache,
+        extensions=[StripNewlinesExtension],
+        finalize=_strip_newlines
+    )
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl, path=None):
+        """
+        带过期时间和容量上限的LRU缓存，线程安全
+        @param maxsize: 最大条数，超出时淘汰最久未使用的
+        @param ttl: 默认过期时间(秒)
+        @param path: 持久化文件，如/tmp下的文件，热启动的容器之间共享；为空则只在内存中
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self._data = OrderedDict()  # {key: (expire_at, value)}
+        self._lock = threading.Lock()
+        self._load()
+
+    def get(self, key, default=MISSING):
+        """
+        读取缓存
+        @param key: key
+        @param default: 未命中或已过期时返回的值
+        @return: 缓存的值
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        写入缓存
+        @param key: key
+        @param value: 可json序列化的值
+        @param ttl: 过期时间(秒)，为空使用默认值
+        @return:
+        """
+        with self._lock:
+            self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self._save()
+
+    def _load(self):
+        if not self.path:
+            return
+        items = load_json(self.path)
+        if not items:
+            return
+        now = time.time()
+        for key, expire_at, value in items[-self.maxsize:]:
+            if expire_at > now:
+                self._data[key] = (expire_at, value)
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            tmp_file = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump([[k, v[0], v[1]] for k, v in self._data.items()], f, ensure_ascii=False)
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            print(e)
+
+
+class AlertSpool:
+    def __init__(self, path):
+        """
+        告警缓冲区，按key(负责人)追加到/tmp下的文件，热启动的多次调用之间共享
+        @param path: 缓冲目录
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.md5(key.encode("utf-8")).hexdigest() + ".jsonl")
+
+    def append(self, key, item):
+        """
+        追加一条告警
+        @param key: 负责人
+        @param item: 可json序列化的告警信息
+        @return:
+        """
+        line = json.dumps({"key": key, "at": time.time(), "item": item}, ensure_ascii=False)
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file(key), "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def pop_due(self, window) -> dict:
+        """
+        取出第一条告警已超过窗口时间的所有缓冲，并清空
+        @param window: 窗口时间(秒)，0取出全部
+        @return: {key: [item]}
+        """
+        data = {}
+        deadline = time.time() - window
+        with self._lock:
+            try:
+                files = os.listdir(self.path)
+            except OSError:
+                return data
+            for name in files:
+                file = os.path.join(self.path, name)
+                try:
+                    with open(file, encoding="utf-8") as f:
+                        lines = [json.loads(i) for i in f if i.strip()]
+                except (OSError, ValueError) as e:
+                    print(e)
+                    continue
+                if lines and lines[0].get("at") <= deadline:
+                    os.remove(file)
+                    data[lines[0].get("key")] = [i.get("item") for i in lines]
+        return data
+
+
 if __name__ == '__main__':
     print(hanzi2pinyin("华为云"))
@@ -1,11 +1,19 @@
 # -*- coding:utf-8 -*-
 
-from huaweicloudsdkcore.auth.credentials import GlobalCredentials, BasicCredentials
+import lazy_sdk
+
+lazy_sdk.install("huaweicloudsdkrms.v1", "huaweicloudsdkevs.v2")
+
 from huaweicloudsdkcore.exceptions import exceptions
-from huaweicloudsdkrms.v1.region.rms_region import RmsRegion
-from huaweicloudsdkevs.v2.region.evs_region import EvsRegion
-from huaweicloudsdkrms.v1 import *
-from huaweicloudsdkevs.v2 import *
+from huaweicloudsdkevs.v2 import CreateSnapshotRequest, CreateSnapshotOption, CreateSnapshotRequestBody, \
+    DeleteSnapshotRequest, ListSnapshotsRequest
+
+from clients import ClientRegistry
+from inventory import RmsInventory, INVENTORY_TTL
+from throttle import MAX_WORKERS
+from retention import RetentionPolicy
+from snapshot_tracker import SnapshotTracker
+from sharding import partition, LocalDispatcher, FunctionGraphDispatcher
 
 import hmac
 import hashlib
@@ -14,32 +22,39 @@ import urllib.parse
 import json
 import time
 import requests
-import multiprocessing
+from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+SNAPSHOT_PAGE_LIMIT = 1000  # ListSnapshots每页数量
+SNAPSHOT_PAGE_WORKERS = 4  # 每个区域并发拉取的页数
+SNAPSHOT_REGION_WORKERS = 8  # 同时拉取快照的区域数
+SNAPSHOT_WAIT = 600  # 等待快照可用的最长时间(秒)，可在函数的环境变量snapshot_wait中覆盖
+DELETE_WORKERS = 16  # 删除过期快照的并发数，与创建快照分开，避免占满创建的线程
+
 
 class HuaweiCloud:
 
-    def __init__(self, ak, sk, max_workers):
+    def __init__(self, ak, sk, max_workers, inventory_ttl=INVENTORY_TTL):
         self.ak = ak
         self.sk = sk
-        self.global_credentials = GlobalCredentials(ak, sk)
-        self.basic_credentials = BasicCredentials(ak, sk)
+        self.clients = ClientRegistry(ak, sk)
         self.errLists = []
         self.max_workers = max_workers
+        self.planned = 0  # 计划创建快照的磁盘数
+        self.expired = 0  # 按保留策略需要删除的快照数
+        self.tracker = SnapshotTracker()
 
         # 此处目前只能填cn-north-4
-        self.rms_client = RmsClient.new_builder() \
-            .with_credentials(self.global_credentials) \
-            .with_region(RmsRegion.value_of("cn-north-4")) \
-            .build()
+        self.rms_client = self.clients.get("rms", "cn-north-4")
+        self.inventory = RmsInventory(self.rms_client, ak, inventory_ttl)
 
-    def create_snapshot(self, client, volume_id, name):
+    def create_snapshot(self, client, volume_id, name, region=None):
         """
-        创建快照
+        创建快照，提交成功后交给tracker跟踪是否可用
         @param client: evs client
         @param volume_id: 磁盘id
         @param name: 快照名
+        @param region: 区域，为空时不跟踪
         @return:
         """
         try:
@@ -53,6 +68,8 @@ class HuaweiCloud:
                 snapshot=snapshotCreateSnapshotOption
             )
             response = client.create_snapshot(request)
+            if region and response.snapshot:
+                self.tracker.add(region, client, response.snapshot.id, name)
             return response
         except exceptions.ClientRequestException as e:
             print(e.status_code)
@@ -79,31 +96,59 @@ class HuaweiCloud:
             print(e.error_msg)
             self.errLists.append({"deleteErr": e.error_msg})
 
+    def list_snapshot_page(self, client, offset) -> tuple:
+        """
+        获取一页快照
+        @param client: evs client
+        @param offset: 偏移量
+        @return: (快照总数, 该页的快照列表)
+        """
+        request = ListSnapshotsRequest()
+        request.limit = SNAPSHOT_PAGE_LIMIT
+        request.offset = offset
+        response = client.list_snapshots(request).to_dict()
+        return response.get("count"), response.get("snapshots") or []
+
     def get_all_snapshots(self, client):
         """
-        获取所有区域的快照信息。
+        获取区域的所有快照。第一页返回总数后，其余各页按offset并发拉取；
+        总数不准确(拉取期间有新快照)或没有返回时，按窗口继续并发拉取，直到某一页不满一页为止
         @param client: evs client
-        @return: {volume_id: [snapshot_id]}
+        @return: {volume_id: [{"id": id, "created_at": created_at, "status": status}]}
         """
         try:
-            offset = 0
+            count, page = self.list_snapshot_page(client, 0)
+            pages = [page]
+            offset = SNAPSHOT_PAGE_LIMIT
+            if len(page) == SNAPSHOT_PAGE_LIMIT:
+                with ThreadPoolExecutor(max_workers=SNAPSHOT_PAGE_WORKERS) as executor:
+                    if count:
+                        offsets = range(offset, count, SNAPSHOT_PAGE_LIMIT)
+                        pages.extend(i[1] for i in executor.map(lambda x: self.list_snapshot_page(client, x), offsets))
+                        offset += len(offsets) * SNAPSHOT_PAGE_LIMIT  # 按页对齐，count不是整页时不会重复拉取
+                    # count正好是整页且最后一页满时，不再多拉一个空的窗口
+                    while len(pages[-1]) == SNAPSHOT_PAGE_LIMIT and not (count and offset == count):
+                        offsets = range(offset, offset + SNAPSHOT_PAGE_LIMIT * SNAPSHOT_PAGE_WORKERS, SNAPSHOT_PAGE_LIMIT)
+                        for _, page in executor.map(lambda x: self.list_snapshot_page(client, x), offsets):
+                            pages.append(page)
+                            if len(page) < SNAPSHOT_PAGE_LIMIT:  # 最后一页，窗口中之后的页都是空的
+                                break
+                        offset = offsets.stop
+
             snapshots = {}
-            request = ListSnapshotsRequest()
-            request.limit = 1000
-            while True:
-                request.offset = offset
-                response = client.list_snapshots(request).to_dict().get('snapshots')
-                if response:
-                    for info in response:
-                        volume_id = info.get("volume_id")
-                        snapshot_id = info.get("id")
-                        if volume_id in snapshots:
-                            snapshots.get(volume_id).append(snapshot_id)
-                        else:
-                            snapshots.update({volume_id: [snapshot_id]})
-                    offset += 1000
-                else:
-                    return snapshots
+            seen = set()  # 拉取期间有快照新增或删除时，相邻两页可能有重复
+            for page in pages:
+                for info in page:
+                    if info.get("id") in seen:
+                        continue
+                    seen.add(info.get("id"))
+                    volume_id = info.get("volume_id")
+                    snapshot = {"id": info.get("id"), "created_at": info.get("created_at"), "status": info.get("status")}
+                    if volume_id in snapshots:
+                        snapshots.get(volume_id).append(snapshot)
+                    else:
+                        snapshots.update({volume_id: [snapshot]})
+            return snapshots
 
         except exceptions.ClientRequestException as e:
             print(e.status_code)
@@ -111,72 +156,100 @@ class HuaweiCloud:
             print(e.error_code)
             print(e.error_msg)
 
+    @staticmethod
+    def iter_volumes(resources):
+        """
+        解析磁盘信息
+        @param resources: rms资源的迭代器，可以是inventory.stream边拉取边解析
+        @return: (region_id, {volume_id: volume_name})
+        """
+        for info in resources:
+            properties = info.get("properties")
+            if properties.get("status") == "in-use":  # 只查使用中的
+                id = info.get("id")
+                region_id = info.get("region_id")
+                name = info.get("name")
+                yield region_id, {id: name}
+
     def get_all_volumes(self):
         """
         获取所有的磁盘信息
         @return: {region_id: [{volume_id: volume_name},{volume_id: volume_name}...],}
         """
         data = {}
-        marker = None
-        request = ListAllResourcesRequest()
-        request.limit = 200  # 目前最大200
-        request.type = "evs.volumes"
-        while True:
-            try:
-                request.marker = marker
-                response = self.rms_client.list_all_resources(request).to_dict()
-                if response:
-                    page_info = response.get("page_info")
-                    next_marker = page_info.get("next_marker")
-                    resources_list = response.get("resources")
-                    for info in resources_list:
-                        properties = info.get("properties")
-                        if properties.get("status") == "in-use":  # 只查使用中的
-                            id = info.get("id")
-                            region_id = info.get("region_id")
-                            name = info.get("name")
-                            if region_id in data:
-                                data[region_id].append({id: name})
-                            else:
-                                data[region_id] = [{id: name}]
-                    if next_marker:
-                        marker = next_marker
-                    else:
-                        return data
-                else:
-                    return data
-            except exceptions.ClientRequestException as e:
-                print(e.status_code)
-                print(e.request_id)
-                print(e.error_code)
-                print(e.error_msg)
-
-    def dojob(self, volumes, max_savetime):
-        """
-        批量创建快照任务
-        @param volumes: 总磁盘数dict
-        @param max_savetime: 最大保留日期
+        for region_id, volume in self.iter_volumes(self.inventory.list_resources("evs.volumes")):
+            if region_id in data:
+                data[region_id].append(volume)
+            else:
+                data[region_id] = [volume]
+        return data
+
+    def backup_volumes(self, executor, delete_executor, region, snapshots, volumes, policy, times, dry_run=False):
+        """
+        提交一个区域的磁盘的快照任务，并按保留策略删除过期的快照
+        @param executor: 创建快照的线程池
+        @param delete_executor: 删除快照的线程池
+        @param region: 区域
+        @param snapshots: 该区域的快照 {volume_id: [snapshot]}
+        @param volumes: [{volume_id: volume_name}]
+        @param policy: RetentionPolicy
+        @param times: 快照名的日期
+        @param dry_run: 只打印计划，不创建也不删除
+        @return: 创建快照的futures
+        """
+        res = []
+        evs_client = self.clients.get("evs", region)
+        now = datetime.utcnow()  # created_at是UTC时间
+        for i in volumes:
+            volume_id = list(i.keys())[0]
+            volume_name = list(i.values())[0]
+            # 只处理可用的快照，创建中、出错的不参与保留计算也不删除
+            available = [s for s in snapshots.get(volume_id) or [] if s.get("status") == "available"]
+            expired = policy.plan(available, pending=now)
+            self.planned += 1
+            self.expired += len(expired)
+            if dry_run:
+                print(f"[dry_run] {region} {volume_name}({volume_id}): 创建快照{volume_name}-{times}，"
+                      f"现有{len(available)}个，删除{len(expired)}个 {[s.get('id') for s in expired]}")
+                continue
+            for snapshot in expired:
+                delete_executor.submit(self.delete_snapshot, client=evs_client, snapshot_id=snapshot.get("id"))
+            future = executor.submit(self.create_snapshot, client=evs_client, volume_id=volume_id,
+                                     name=volume_name + '-' + times, region=region)
+            res.append(future)
+        return res
+
+    def dojob(self, volumes, policy, dry_run=False):
+        """
+        批量创建快照任务，边拉取磁盘边提交。每个区域第一次出现时就在后台开始拉取该区域的快照，
+        各区域的快照同时拉取，某个区域拉取完成后立即提交该区域已到达的磁盘，不需要等其他区域
+        @param volumes: (region_id, {volume_id: volume_name}) 的迭代器
+        @param policy: 快照保留策略 RetentionPolicy
+        @param dry_run: 只打印计划，不创建也不删除
         @return: 执行结果
         """
         res = []
         times = time.strftime("%Y-%m-%d", time.localtime())
+        listings = {}  # {region: 快照列表的future}
+        pending = {}  # {region: [{volume_id: volume_name}]} 等待快照列表的磁盘
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                ThreadPoolExecutor(max_workers=DELETE_WORKERS) as delete_executor, \
+                ThreadPoolExecutor(max_workers=SNAPSHOT_REGION_WORKERS) as list_executor:
+            def backup(region, snapshots):
+                return self.backup_volumes(executor, delete_executor, region, snapshots or {}, pending.pop(region),
+                                           policy, times, dry_run)
+
+            for region, i in volumes:
+                if region not in listings:
+                    listings[region] = list_executor.submit(self.get_all_snapshots, self.clients.get("evs", region))
+                pending.setdefault(region, []).append(i)
+                for ready in [r for r in pending if listings[r].done()]:
+                    res += backup(ready, listings[ready].result())
 
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            for region, value in volumes.items():
-                evs_client = EvsClient.new_builder() \
-                    .with_credentials(BasicCredentials(self.ak, self.sk)) \
-                    .with_region(EvsRegion.value_of(region)).build()
-
-                snapshots = self.get_all_snapshots(evs_client)
-                for i in value:
-                    volume_id = list(i.keys())[0]
-                    volume_name = list(i.values())[0]
-                    snapshot_lists = snapshots.get(volume_id)
-                    if snapshot_lists and len(snapshot_lists) >= int(max_savetime):
-                        executor.submit(self.delete_snapshot, client=evs_client, snapshot_id=snapshot_lists[-1])
-                    future = executor.submit(self.create_snapshot, client=evs_client, volume_id=volume_id,
-                                             name=volume_name + '-' + times)
-                    res.append(future)
+            waiting = {listings[r]: r for r in pending}
+            for future in as_completed(waiting):
+                res += backup(waiting[future], future.result())
         return res
 
     @staticmethod
@@ -212,24 +285,131 @@ class HuaweiCloud:
             print(e)
 
 
+def run_backup(huaweicloud, volumes, policy, dry_run, wait) -> dict:
+    """
+    执行快照任务并统计结果
+    @param huaweicloud: HuaweiCloud
+    @param volumes: (region_id, {volume_id: volume_name}) 的迭代器
+    @param policy: RetentionPolicy
+    @param dry_run: 只打印计划，不创建也不删除
+    @param wait: 等待快照可用的最长时间(秒)
+    @return: 统计结果，可json序列化，分片时由协调者汇总
+    """
+    response = huaweicloud.dojob(volumes, policy, dry_run)  # 每个磁盘对应一个创建任务
+    summary = {"volumes": huaweicloud.planned, "submitted": 0, "available": 0, "seconds_total": 0, "seconds_max": 0,
+               "failed": 0, "stragglers": 0, "expired": huaweicloud.expired, "errors": huaweicloud.errLists}
+    if dry_run:
+        return summary
+
+    result = [i.result() for i in response if i.result() is not None]
+    report = huaweicloud.tracker.wait(max(0, wait))
+    seconds = [i[1] for i in report["available"].values()]
+    for snapshot_id, name in report["failed"].items():
+        huaweicloud.errLists.append({"snapshotErr": "snapshot status is error, name is " + name})
+    for snapshot_id, name in report["stragglers"].items():
+        print(f"未完成的快照: {name}({snapshot_id})")
+    summary.update({
+        "submitted": len(result),
+        "available": len(seconds),
+        "seconds_total": sum(seconds),
+        "seconds_max": max(seconds) if seconds else 0,
+        "failed": len(report["failed"]),
+        "stragglers": len(report["stragglers"]),
+    })
+    return summary
+
+
+def merge_summaries(summaries) -> dict:
+    """
+    汇总各分片的统计结果
+    @param summaries: run_backup的返回值列表，失败的分片为None
+    @return: 统计结果，增加shards_failed
+    """
+    total = {"volumes": 0, "submitted": 0, "available": 0, "seconds_total": 0, "seconds_max": 0, "failed": 0,
+             "stragglers": 0, "expired": 0, "errors": [], "shards_failed": 0}
+    for summary in summaries:
+        if summary is None:
+            total["shards_failed"] += 1
+            continue
+        for key in ("volumes", "submitted", "available", "seconds_total", "failed", "stragglers", "expired"):
+            total[key] += summary.get(key) or 0
+        total["seconds_max"] = max(total["seconds_max"], summary.get("seconds_max") or 0)
+        total["errors"].extend(summary.get("errors") or [])
+    return total
+
+
+def format_summary(summary, policy, dry_run) -> str:
+    if dry_run:
+        msg = f"[dry_run] 保留策略 {policy}，硬盘总数共{summary['volumes']}个，需删除{summary['expired']}个快照"
+    else:
+        seconds = ""
+        if summary["available"]:
+            seconds = "(平均耗时{:.0f}秒，最长{:.0f}秒)".format(summary["seconds_total"] / summary["available"],
+                                                       summary["seconds_max"])
+        msg = "硬盘总数共{}个，提交创建{}个快照，可用{}个{}，失败{}个，超时未完成{}个，提交删除过期快照{}个！".format(
+            summary["volumes"], summary["submitted"], summary["available"], seconds, summary["failed"],
+            summary["stragglers"], summary["expired"])
+    if summary.get("shards_failed"):
+        msg += "\n{}个分片执行失败！".format(summary["shards_failed"])
+    return msg
+
+
+def get_dispatcher(huaweicloud, context):
+    """
+    配置了worker_urn时通过FunctionGraph同步调用工作者函数，否则在当前进程中执行各分片
+    @param huaweicloud: HuaweiCloud
+    @param context: 函数的context
+    @return: 分发器
+    """
+    worker_urn = context.getUserData("worker_urn")  # urn:fss:cn-north-4:project_id:function:default:name:latest
+    if worker_urn:
+        region = worker_urn.split(":")[2]
+        return FunctionGraphDispatcher(huaweicloud.clients.get("functiongraph", region), worker_urn)
+    return LocalDispatcher(handler, context)
+
+
 def handler(event, context):
     ak = context.getAccessKey()
     sk = context.getSecretKey()
     dd_token = context.getUserData("dd_token")
     dd_secret = context.getUserData("dd_secret")
-    max_savetime = context.getUserData("max_savetime")
+    max_savetime = context.getUserData("max_savetime")  # 每个磁盘保留的快照数(含本次创建的)
+    policy = RetentionPolicy(
+        keep_last=int(max_savetime or 0),
+        daily=int(context.getUserData("keep_daily") or 0),
+        weekly=int(context.getUserData("keep_weekly") or 0),
+        monthly=int(context.getUserData("keep_monthly") or 0),
+    )
+    dry_run = context.getUserData("dry_run") == "true"  # 只打印计划，不创建也不删除
+    shards = int(context.getUserData("shards") or 0)  # 大于1时作为协调者，把磁盘分片交给多个工作者调用
+    shard_by = context.getUserData("shard_by") or "region"  # region按区域分片，hash按磁盘id分片
+    # 留出发送通知的时间，不超过函数的剩余执行时间
+    wait = int(context.getUserData("snapshot_wait") or SNAPSHOT_WAIT)
+    wait = min(wait, context.getRemainingTimeInMilliSeconds() / 1000 - 30)
 
-    max_workers = multiprocessing.cpu_count() * 6  # 线程池任务最大数量
-    huaweicloud = HuaweiCloud(ak, sk, max_workers)
-    volumes = huaweicloud.get_all_volumes()
-    response = huaweicloud.dojob(volumes, max_savetime)
-    result = [i.result() for i in response if i.result() is not None]
-    total_volumes = [i for lst in volumes.values() for i in lst]
-    dingding_msg = "硬盘总数共{}个，成功创建{}个快照！".format(len(total_volumes), len(result))
+    max_workers = int(context.getUserData("max_workers") or MAX_WORKERS)  # 线程池大小，实际并发由throttle按限流情况调整
+    inventory_ttl = int(context.getUserData("inventory_ttl") or INVENTORY_TTL)
+    huaweicloud = HuaweiCloud(ak, sk, max_workers, inventory_ttl)
+
+    # 工作者调用：只处理协调者分配的磁盘，统计结果返回给协调者
+    if "shard" in event:
+        volumes = ((region, i) for region, items in event["shard"].items() for i in items)
+        return run_backup(huaweicloud, volumes, policy, dry_run, wait)
+
+    if shards > 1:
+        parts = partition(huaweicloud.get_all_volumes(), shards, shard_by, key=lambda x: list(x.keys())[0])
+        print(f"共{len(parts)}个分片，每片磁盘数 {[sum(len(v) for v in i.values()) for i in parts]}")
+        summary = merge_summaries(get_dispatcher(huaweicloud, context).dispatch([{"shard": i} for i in parts]))
+    else:
+        volumes = huaweicloud.iter_volumes(huaweicloud.inventory.stream("evs.volumes"))
+        summary = run_backup(huaweicloud, volumes, policy, dry_run, wait)
+
+    dingding_msg = format_summary(summary, policy, dry_run)
     print(dingding_msg)
-    huaweicloud.send_dingding(dd_secret, dd_token, dingding_msg)
-    if huaweicloud.errLists:
-        huaweicloud.send_dingding(str(huaweicloud.errLists))
+    if not dry_run:
+        huaweicloud.send_dingding(dd_secret, dd_token, dingding_msg)
+        if summary["errors"]:
+            huaweicloud.send_dingding(dd_secret, dd_token, str(summary["errors"]))
 
     return {
         "statusCode": 200,
@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+"""
+冷启动基准：每个函数的入口模块在独立的子进程中导入，统计导入耗时、内存(RSS)和加载的模块数。
+用法：python benchmarks/cold_start.py -n 5
+对比全量导入SDK：HUAWEICLOUD_LAZY_SDK=0 python benchmarks/cold_start.py -n 5
+"""
+
+_root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# 函数名: (代码目录, 入口模块)
+HANDLERS = {
+    "modify_title": (_root, "modify_title"),
+    "modify_tag_and_projectId": (_root, "modify_tag_and_projectId"),
+    "batch_create_snapshots": (_root, "batch_create_snapshots"),
+    "add_to_monitorgroup": (_root, "add_to_monitorgroup"),
+    "alert_to_manager": (os.path.join(_root, "alert_to_manager"), "index"),
+}
+
+_PROBE = """
+import importlib, json, resource, sys, time
+sys.path[:0] = {paths!r}
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+modules_before = len(sys.modules)
+start = time.perf_counter()
+module = importlib.import_module({module!r})
+seconds = time.perf_counter() - start
+assert callable(module.handler)
+rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"seconds": seconds, "rss_kb": rss_after, "rss_delta_kb": rss_after - rss_before,
+                  "modules": len(sys.modules) - modules_before}}))
+"""
+
+
+def probe(path, module) -> dict:
+    """
+    在新的解释器中导入一次入口模块
+    @param path: 代码目录
+    @param module: 入口模块名
+    @return: {"seconds": 导入耗时, "rss_kb": 峰值RSS, "rss_delta_kb": 导入增加的RSS, "modules": 导入的模块数}
+    """
+    code = _PROBE.format(paths=[path, _root], module=module)
+    output = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="各函数入口的冷启动导入耗时和内存")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="每个函数重复的次数，取中位数")
+    parser.add_argument("handlers", nargs="*", default=list(HANDLERS), help="只测试这些函数")
+    args = parser.parse_args()
+
+    print("lazy sdk: {}".format(os.environ.get("HUAWEICLOUD_LAZY_SDK", "1") != "0"))
+    print("{:<28}{:>12}{:>12}{:>14}{:>10}".format("handler", "import(ms)", "rss(MB)", "rss delta(MB)", "modules"))
+    for name in args.handlers:
+        path, module = HANDLERS[name]
+        results = [probe(path, module) for _ in range(args.runs)]
+        print("{:<28}{:>12.1f}{:>12.1f}{:>14.1f}{:>10d}".format(
+            name,
+            statistics.median(i["seconds"] for i in results) * 1000,
+            statistics.median(i["rss_kb"] for i in results) / 1024,
+            statistics.median(i["rss_delta_kb"] for i in results) / 1024,
+            int(statistics.median(i["modules"] for i in results))
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+
+import os
+import json
+import gzip
+import time
+import hashlib
+import threading
+
+"""
+本地持久化缓存，数据以gzip压缩的json保存在/tmp下。
+同一个容器内的多次调用(热启动)以及同一实例上的多个函数都可以复用，过期时间由ttl控制。
+"""
+
+CACHE_DIR = os.environ.get("HUAWEICLOUD_CACHE_DIR", "/tmp/huaweicloud_cache")
+
+_memory = {}  # 进程内缓存 {(namespace, key): {"saved_at": saved_at, "value": value}}
+_memory_lock = threading.Lock()
+
+
+def account_key(ak) -> str:
+    """
+    按账号区分缓存目录，避免不同账号的数据互相覆盖
+    @param ak: access key
+    @return: ak的摘要
+    """
+    return hashlib.sha1(ak.encode("utf-8")).hexdigest()[:12]
+
+
+class PersistentCache:
+    def __init__(self, namespace, ttl):
+        """
+        @param namespace: 缓存命名空间，对应/tmp下的一个目录
+        @param ttl: 过期时间(秒)
+        """
+        self.namespace = namespace
+        self.ttl = ttl
+        self.path = os.path.join(CACHE_DIR, namespace)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".json.gz")
+
+    def _load(self, key):
+        try:
+            with gzip.open(self._file(key), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key):
+        """
+        读取缓存，先查内存再查文件
+        @param key: 缓存key
+        @return: 缓存的值，不存在或已过期返回None
+        """
+        item = _memory.get((self.namespace, key))
+        if item is None:
+            item = self._load(key)
+            if item is None:
+                return None
+            with _memory_lock:
+                _memory[(self.namespace, key)] = item
+        if time.time() - item.get("saved_at", 0) > self.ttl:
+            return None
+        return item.get("value")
+
+    def set(self, key, value):
+        """
+        写入缓存，先写临时文件再替换，避免并发读取到写了一半的文件
+        @param key: 缓存key
+        @param value: 可json序列化的值
+        @return:
+        """
+        item = {"saved_at": time.time(), "value": value}
+        with _memory_lock:
+            _memory[(self.namespace, key)] = item
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_file = "{}.{}.{}.tmp".format(self._file(key), os.getpid(), threading.get_ident())
+            with gzip.open(tmp_file, "wt", encoding="utf-8") as f:
+                json.dump(item, f, ensure_ascii=False)
+            os.replace(tmp_file, self._file(key))
+        except OSError as e:
+            print(e)
@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+
+from cache import PersistentCache, account_key
+
+import json
+import hashlib
+import threading
+
+"""
+增量变更检测，记录上一次运行时每个资源关键字段(名称、标签、企业项目、ip、大小、挂载信息等)的摘要，
+任务只处理摘要发生变化或新增的资源。
+"""
+
+
+class ChangeTracker:
+    def __init__(self, ak, job_name, incremental=True):
+        """
+        @param ak: access key，用于区分不同账号
+        @param job_name: 任务名，每个任务单独保存一份摘要
+        @param incremental: False时全量处理所有资源，但仍会记录摘要供下次增量使用
+        """
+        self.job_name = job_name
+        self.incremental = incremental
+        self.cache = PersistentCache("changes_" + account_key(ak), float("inf"))
+        self.unchanged = 0
+        self._previous = self.cache.get(job_name) or {}
+        self._current = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(*parts) -> str:
+        """
+        计算摘要
+        @param parts: 参与计算的字段，可json序列化即可
+        @return: sha1
+        """
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def is_changed(self, key, *parts) -> bool:
+        """
+        判断资源与上次运行相比是否有变化
+        @param key: 资源的唯一标识，如ecs:id
+        @param parts: 决定该资源是否需要处理的字段，依赖其他资源的(如磁盘依赖服务器的ip)也要一起传入
+        @return: 有变化或新增返回True，处理完成后需调用mark_done
+        """
+        digest = self.fingerprint(*parts)
+        with self._lock:
+            if self.incremental and self._previous.get(key) == digest:
+                self._current[key] = digest
+                self.unchanged += 1
+                return False
+            self._pending[key] = digest
+            return True
+
+    def mark_done(self, key):
+        """
+        标记资源已处理完成(已经是期望的状态)，下次运行摘要不变时跳过。
+        提交了修改的资源不要标记，修改成功后摘要会变化，下次运行再确认一次；修改失败则下次重试。
+        @param key: 资源的唯一标识
+        @return:
+        """
+        with self._lock:
+            digest = self._pending.pop(key, None)
+            if digest:
+                self._current[key] = digest
+
+    def save(self):
+        """
+        保存本次运行的摘要，已删除的资源不再保留
+        @return:
+        """
+        with self._lock:
+            self.cache.set(self.job_name, self._current)
@@ -0,0 +1,90 @@
+# -*- coding:utf-8 -*-
+
+from huaweicloudsdkcore.auth.credentials import BasicCredentials, GlobalCredentials
+from huaweicloudsdkcore.http.http_config import HttpConfig
+
+from throttle import ThrottledClient, get_throttle
+
+import lazy_sdk
+import importlib
+import threading
+
+"""
+区域SDK客户端注册表，按(服务, 区域)缓存客户端，每个容器只构建一次，热启动的多次调用之间复用，
+避免每次调用、每个区域都重新构建客户端和建立TLS连接。返回的客户端经过throttle限流。
+"""
+
+# 服务名: (sdk包, 客户端类名, 区域类名, 是否全局服务)
+SERVICES = {
+    "ecs": ("huaweicloudsdkecs.v2", "EcsClient", "EcsRegion", False),
+    "evs": ("huaweicloudsdkevs.v2", "EvsClient", "EvsRegion", False),
+    "eip": ("huaweicloudsdkeip.v2", "EipClient", "EipRegion", False),
+    "ces": ("huaweicloudsdkces.v1", "CesClient", "CesRegion", False),
+    "ces_v2": ("huaweicloudsdkces.v2", "CesClient", "CesRegion", False),  # 监控组批量添加/删除资源
+    "rms": ("huaweicloudsdkrms.v1", "RmsClient", "RmsRegion", True),
+    "eps": ("huaweicloudsdkeps.v1", "EpsClient", "EpsRegion", True),
+    "iam": ("huaweicloudsdkiam.v3", "IamClient", "IamRegion", True),
+    "tms": ("huaweicloudsdktms.v1", "TmsClient", "TmsRegion", True),
+    "functiongraph": ("huaweicloudsdkfunctiongraph.v2", "FunctionGraphClient", "FunctionGraphRegion", False),
+}
+
+# 默认读超时120秒，同步调用函数需要等到工作者执行完成
+HTTP_TIMEOUTS = {"functiongraph": (60, 900)}  # 服务名: (连接超时, 读超时)
+
+_clients = {}  # {(service, region): (ak, sk, client)}
+_key_locks = {}  # {(service, region): Lock}，构建客户端需要请求IAM获取项目id，只锁同一个(服务, 区域)
+_key_locks_lock = threading.Lock()
+_import_lock = threading.Lock()
+
+
+class ClientRegistry:
+    def __init__(self, ak, sk):
+        """
+        @param ak: access key
+        @param sk: secret key，ak/sk变化时对应的客户端会重新构建
+        """
+        self.ak = ak
+        self.sk = sk
+
+    def get(self, service, region):
+        """
+        获取客户端，不存在时构建，线程安全
+        @param service: 服务名，见SERVICES，如ecs evs rms
+        @param region: 区域，如cn-southwest-2，全局服务(rms eps iam)填写其接入的区域
+        @return: 经过限流包装的客户端
+        """
+        key = (service, region)
+        entry = _clients.get(key)
+        if entry and entry[0] == self.ak and entry[1] == self.sk:
+            return entry[2]
+        with self._key_lock(key):
+            entry = _clients.get(key)
+            if entry and entry[0] == self.ak and entry[1] == self.sk:
+                return entry[2]
+            client = ThrottledClient(self._build(service, region), get_throttle(service, region))
+            _clients[key] = (self.ak, self.sk, client)
+            return client
+
+    @staticmethod
+    def _key_lock(key):
+        with _key_locks_lock:
+            if key not in _key_locks:
+                _key_locks[key] = threading.Lock()
+            return _key_locks[key]
+
+    def _build(self, service, region):
+        package, client_name, region_name, is_global = SERVICES[service]
+        module = package.split(".")[0][len("huaweicloudsdk"):]  # 如huaweicloudsdkces.v2 => ces
+        with _import_lock:  # 同一个SDK包的多个区域同时构建时只替换一次
+            lazy_sdk.install(package)
+            client_class = getattr(importlib.import_module(f"{package}.{module}_client"), client_name)
+            region_class = getattr(importlib.import_module(f"{package}.region.{module}_region"), region_name)
+        credentials = GlobalCredentials(self.ak, self.sk) if is_global else BasicCredentials(self.ak, self.sk)
+        builder = client_class.new_builder() \
+            .with_credentials(credentials) \
+            .with_region(region_class.value_of(region))
+        if service in HTTP_TIMEOUTS:
+            config = HttpConfig.get_default_config()
+            config.timeout = HTTP_TIMEOUTS[service]
+            builder = builder.with_http_config(config)
+        return builder.build()
@@ -0,0 +1,194 @@
+# -*- coding:utf-8 -*-
+
+from typing import NamedTuple
+
+"""
+RMS资源的内存索引，服务器、磁盘、公网ip、带宽解析为带类型的对象，按id、公网ip和区域建立哈希索引，
+各任务之间的关联(磁盘所挂载的服务器、服务器的公网ip等)都是O(1)查找，不再逐个遍历。
+"""
+
+
+class Server(NamedTuple):
+    id: str
+    name: str
+    region_id: str
+    status: str
+    private_ip: str
+    public_ip: str
+    vcpus: str
+    ram: int  # MB
+    tags: dict
+    ep_id: str
+
+    @classmethod
+    def from_rms(cls, info):
+        properties = info.get("properties") or {}
+        addresses = properties.get("addresses") or []
+        flavor = properties.get("flavor") or {}
+        return cls(
+            id=info.get("id"),
+            name=info.get("name"),
+            region_id=info.get("region_id"),
+            status=properties.get("status"),
+            private_ip=addresses[0].get("addr") if addresses else None,
+            public_ip=addresses[1].get("addr") if len(addresses) > 1 else None,
+            vcpus=flavor.get("vcpus"),
+            ram=int(flavor.get("ram") or 0),
+            tags=info.get("tags") or {},
+            ep_id=info.get("ep_id"),
+        )
+
+
+class Volume(NamedTuple):
+    id: str
+    name: str
+    region_id: str
+    status: str
+    size: int
+    volume_type: str
+    server_id: str  # 挂载的服务器，未挂载为None
+    device: str  # 挂载点，如/dev/vda
+    tags: dict
+    ep_id: str
+
+    @classmethod
+    def from_rms(cls, info):
+        properties = info.get("properties") or {}
+        attachments = properties.get("attachments") or [{}]
+        return cls(
+            id=info.get("id"),
+            name=info.get("name"),
+            region_id=info.get("region_id"),
+            status=properties.get("status"),
+            size=properties.get("size"),
+            volume_type=properties.get("volumeType"),
+            server_id=attachments[0].get("serverId"),
+            device=attachments[0].get("device"),
+            tags=info.get("tags") or {},
+            ep_id=info.get("ep_id"),
+        )
+
+
+class PublicIp(NamedTuple):
+    id: str
+    region_id: str
+    status: str
+    public_ip: str
+    private_ip: str
+    instance_type: str  # 绑定的实例类型，如PORT
+    bandwidth_id: str
+    bandwidth_name: str
+    bandwidth_size: int  # Mbit/s
+    charge_mode: str  # traffic=按流量，bandwidth=包年包月
+    tags: dict
+
+    @classmethod
+    def from_rms(cls, info):
+        properties = info.get("properties") or {}
+        bandwidth = properties.get("bandwidth") or {}
+        return cls(
+            id=info.get("id"),
+            region_id=info.get("region_id"),
+            status=properties.get("status"),
+            public_ip=properties.get("publicIpAddress"),
+            private_ip=(properties.get("vnic") or {}).get("privateIpAddress"),
+            instance_type=properties.get("associateInstanceType"),
+            bandwidth_id=bandwidth.get("id"),
+            bandwidth_name=bandwidth.get("name"),
+            bandwidth_size=bandwidth.get("size"),
+            charge_mode=bandwidth.get("chargeMode"),
+            tags=info.get("tags") or {},
+        )
+
+
+class Bandwidth(NamedTuple):
+    id: str
+    name: str
+    region_id: str
+    tags: dict
+
+    @classmethod
+    def from_rms(cls, info):
+        return cls(id=info.get("id"), name=info.get("name"), region_id=info.get("region_id"),
+                   tags=info.get("tags") or {})
+
+
+class Resource(NamedTuple):
+    """
+    其他类型的资源，只保留公共字段
+    """
+    id: str
+    name: str
+    region_id: str
+    tags: dict
+
+    @classmethod
+    def from_rms(cls, info):
+        return cls(id=info.get("id"), name=info.get("name"), region_id=info.get("region_id"),
+                   tags=info.get("tags") or {})
+
+
+RESOURCE_CLASSES = {
+    "ecs.cloudservers": Server,
+    "evs.volumes": Volume,
+    "vpc.publicips": PublicIp,
+    "vpc.bandwidths": Bandwidth,
+}
+
+
+class InventoryGraph:
+    def __init__(self):
+        self._by_id = {}  # {resource_type: {id: 资源}}
+        self._by_region = {}  # {(resource_type, region_id): [资源]}
+        self._by_public_ip = {}  # {公网ip: PublicIp}
+
+    def add(self, resource_type, info):
+        """
+        解析一个RMS资源并加入索引
+        @param resource_type: 资源类型，如ecs.cloudservers
+        @param info: ListAllResources返回的资源
+        @return: 带类型的资源对象
+        """
+        item = RESOURCE_CLASSES.get(resource_type, Resource).from_rms(info)
+        self._by_id.setdefault(resource_type, {})[item.id] = item
+        self._by_region.setdefault((resource_type, item.region_id), []).append(item)
+        if isinstance(item, PublicIp) and item.public_ip:
+            self._by_public_ip[item.public_ip] = item
+        return item
+
+    def stream(self, resource_type, resources):
+        """
+        边加入索引边返回，可以直接接在inventory.stream后面
+        @param resource_type: 资源类型
+        @param resources: RMS资源的迭代器
+        @return: 带类型的资源对象的迭代器
+        """
+        for info in resources:
+            yield self.add(resource_type, info)
+
+    def load(self, inventory, resource_types):
+        """
+        从清单(缓存)加载多种类型的全部资源
+        @param inventory: RmsInventory
+        @param resource_types: 资源类型列表
+        @return: self
+        """
+        for resource_type in resource_types:
+            for _ in self.stream(resource_type, inventory.list_resources(resource_type)):
+                pass
+        return self
+
+    def all(self, resource_type) -> list:
+        return list(self._by_id.get(resource_type, {}).values())
+
+    def get(self, resource_type, resource_id):
+        return self._by_id.get(resource_type, {}).get(resource_id)
+
+    def server(self, server_id) -> Server:
+        return self.get("ecs.cloudservers", server_id)
+
+    def public_ip(self, ip) -> PublicIp:
+        return self._by_public_ip.get(ip)
+
+    def in_region(self, resource_type, region_id) -> list:
+        return self._by_region.get((resource_type, region_id), [])
@@ -0,0 +1,175 @@
+# -*- coding:utf-8 -*-
+
+import lazy_sdk
+
+lazy_sdk.install("huaweicloudsdkrms.v1")
+
+from huaweicloudsdkcore.exceptions import exceptions
+from huaweicloudsdkrms.v1 import ListAllResourcesRequest, ListRegionsRequest
+
+from cache import PersistentCache, account_key
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+RMS资源清单，每种资源类型(ecs.cloudservers、evs.volumes、vpc.*等)只翻页拉取一次，
+结果持久化到本地并设置过期时间，所有任务及热启动的容器都直接读取，不再重复调用ListAllResources翻页。
+"""
+
+INVENTORY_TTL = 600  # 清单缓存的过期时间(秒)，可在函数的环境变量inventory_ttl中覆盖
+RMS_PAGE_LIMIT = 200  # 目前最大200
+FANOUT_WORKERS = 8  # 每种资源按区域拆分后并发翻页的线程数
+
+_CHAIN_END = object()  # 翻页链结束的标记
+
+_type_locks = {}  # 同一种资源同一时间只允许一个线程拉取，其他线程等待后直接读缓存
+_type_locks_lock = threading.Lock()
+
+
+class RmsInventory:
+    def __init__(self, rms_client, ak, ttl=INVENTORY_TTL):
+        """
+        @param rms_client: rms client，目前只能是cn-north-4
+        @param ak: access key，用于区分不同账号的缓存
+        @param ttl: 缓存过期时间(秒)
+        """
+        self.rms_client = rms_client
+        self.cache = PersistentCache("inventory_" + account_key(ak), ttl)
+
+    def _type_lock(self, resource_type):
+        key = (self.cache.namespace, resource_type)
+        with _type_locks_lock:
+            if key not in _type_locks:
+                _type_locks[key] = threading.Lock()
+            return _type_locks[key]
+
+    def list_resources(self, resource_type, region_id=None) -> list:
+        """
+        获取某种类型的全部资源，优先读缓存
+        @param resource_type: 资源类型，如ecs.cloudservers evs.volumes vpc.publicips
+        @param region_id: 只返回该区域的资源，None返回所有区域
+        @return: ListAllResources返回的resources列表
+        """
+        with self._type_lock(resource_type):
+            resources = self.cache.get(resource_type)
+            if resources is None:
+                resources = list(self.stream(resource_type))
+        if region_id:
+            return [i for i in resources if i.get("region_id") == region_id]
+        return resources
+
+    def list_regions(self) -> list:
+        """
+        获取RMS支持的所有区域
+        @return: [region_id]
+        """
+        regions = self.cache.get("regions")
+        if regions is None:
+            try:
+                response = self.rms_client.list_regions(ListRegionsRequest()).to_dict()
+                regions = [i.get("region_id") for i in response.get("value") or []]
+                self.cache.set("regions", regions)
+            except exceptions.ClientRequestException as e:
+                print(e.status_code)
+                print(e.error_code)
+                print(e.error_msg)
+                regions = []
+        return regions
+
+    def stream(self, resource_type):
+        """
+        流式获取某种类型的全部资源。缓存有效时直接读缓存；否则调用时即在后台开始翻页，
+        边拉取边返回，全部返回后写入缓存。适合一边拉取一边提交修改任务
+        @param resource_type: 资源类型
+        @return: 资源的迭代器
+        """
+        resources = self.cache.get(resource_type)
+        if resources is not None:
+            return iter(resources)
+        paginator = ResourcePaginator(self.rms_client, resource_type, self.list_regions())
+        return self._stream_and_cache(resource_type, paginator)
+
+    def _stream_and_cache(self, resource_type, paginator):
+        resources = []
+        for info in paginator:
+            resources.append(info)
+            yield info
+        self.cache.set(resource_type, resources)
+
+
+class ResourcePaginator:
+    def __init__(self, rms_client, resource_type, regions=None):
+        """
+        ListAllResources的流式分页器，按区域拆分成多条next_marker翻页链在后台线程中拉取，
+        调用方处理当前页时下一页已经在请求中，资源按页到达的顺序返回
+        @param rms_client: rms client
+        @param resource_type: 资源类型
+        @param regions: 区域列表，为空时只有一条全局的翻页链
+        """
+        self.rms_client = rms_client
+        self.resource_type = resource_type
+        self._pages = queue.Queue()
+        self._stop = threading.Event()
+        regions = regions or [None]
+        self._chains = len(regions)
+        executor = ThreadPoolExecutor(max_workers=min(FANOUT_WORKERS, len(regions)))
+        for region_id in regions:
+            executor.submit(self._run_chain, region_id)
+        executor.shutdown(wait=False)
+
+    def __iter__(self):
+        finished = 0
+        try:
+            while finished < self._chains:
+                page = self._pages.get()
+                if page is _CHAIN_END:
+                    finished += 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            self._stop.set()  # 调用方提前结束迭代时，后台的翻页链也随之停止
+
+    def _run_chain(self, region_id):
+        try:
+            for page in self._iter_pages(region_id):
+                self._pages.put(page)
+                if self._stop.is_set():
+                    break
+        except Exception as e:
+            self._pages.put(e)
+        finally:
+            self._pages.put(_CHAIN_END)
+
+    def _iter_pages(self, region_id):
+        """
+        通过next_marker翻页拉取
+        @param region_id: 只拉取该区域的资源，None为所有区域
+        @return: 每页的resources列表
+        """
+        marker = None
+        request = ListAllResourcesRequest()
+        request.limit = RMS_PAGE_LIMIT
+        request.type = self.resource_type
+        request.region_id = region_id
+        while True:
+            request.marker = marker
+            try:
+                # 限流和服务端错误已由throttle退避重试，这里的异常不可重试，直接结束这条翻页链
+                response = self.rms_client.list_all_resources(request).to_dict()
+            except exceptions.ClientRequestException as e:
+                print(e.status_code)
+                print(e.request_id)
+                print(e.error_code)
+                print(e.error_msg)
+                raise
+            if not response:
+                return
+            yield response.get("resources") or []
+            next_marker = response.get("page_info").get("next_marker")
+            if not next_marker:
+                return
+            marker = next_marker
@@ -0,0 +1,163 @@
+# -*- coding:utf-8 -*-
+
+from cache import CACHE_DIR, account_key
+from changes import ChangeTracker
+
+import os
+import abc
+import json
+import time
+import threading
+
+"""
+任务进度日志，只追加。每次修改成功后记录(资源, 目标状态)，函数超时或中途退出后，下一次运行直接跳过已完成的修改，
+不用等清单缓存过期，也不会重复提交前面已经处理过的资源。
+记录只需要覆盖清单缓存的有效期，超过ttl后清单已重新拉取，能看到修改后的状态，记录随之失效。
+默认保存在/tmp下，只对同一实例有效；需要跨实例续跑时实现JournalStore的三个方法接入OBS等外部存储。
+"""
+
+DEADLINE_MARGIN = 30  # 函数剩余执行时间少于该值(秒)时停止提交新的修改
+
+
+class JournalStore(abc.ABC):
+    """
+    日志存储的接口
+    """
+
+    @abc.abstractmethod
+    def read(self) -> list:
+        """
+        @return: 已记录的所有行
+        """
+
+    @abc.abstractmethod
+    def append(self, line):
+        """
+        追加一行
+        @param line: json字符串
+        @return:
+        """
+
+    @abc.abstractmethod
+    def clear(self):
+        """
+        清空所有行
+        @return:
+        """
+
+
+class LocalJournalStore(JournalStore):
+    def __init__(self, path):
+        """
+        @param path: 日志文件，如/tmp下的jsonl文件
+        """
+        self.path = path
+
+    def read(self) -> list:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return [i for i in f.read().split("\n") if i]
+        except OSError:
+            return []
+
+    def append(self, line):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class Journal:
+    def __init__(self, ak, job_name, ttl, store=None):
+        """
+        @param ak: access key，用于区分不同账号
+        @param job_name: 任务名，每个任务单独一份日志
+        @param ttl: 记录的有效期(秒)，与清单缓存的过期时间一致
+        @param store: JournalStore，默认保存在/tmp下
+        """
+        self.store = store or LocalJournalStore(
+            os.path.join(CACHE_DIR, "journal_" + account_key(ak), job_name + ".jsonl"))
+        self.ttl = ttl
+        self.skipped = 0
+        self._done = {}  # {key: (目标状态的摘要, 记录时间)}
+        self._lock = threading.Lock()
+        expire_at = time.time() - ttl
+        for line in self.store.read():
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue  # 超时时可能只写了半行
+            if not isinstance(item, dict) or not isinstance(item.get("at"), (int, float)) or "key" not in item:
+                continue  # 不是本模块写入的行
+            if item.get("at") > expire_at:
+                self._done[item.get("key")] = (item.get("target"), item.get("at"))
+        if self._done:
+            print(f"已记录{len(self._done)}个最近的修改")
+
+    def is_done(self, key, *target) -> bool:
+        """
+        该资源是否已经修改为目标状态
+        @param key: 资源的唯一标识，如ecs:id
+        @param target: 目标状态，如新名称、标签
+        @return:
+        """
+        done = self._done.get(key, (None,))[0] == ChangeTracker.fingerprint(*target)
+        if done:
+            with self._lock:
+                self.skipped += 1
+        return done
+
+    def record(self, key, *target):
+        """
+        记录修改成功，修改接口返回后立即调用
+        @param key: 资源的唯一标识
+        @param target: 目标状态，与is_done的参数一致
+        @return:
+        """
+        digest = ChangeTracker.fingerprint(*target)
+        at = time.time()
+        line = json.dumps({"key": key, "target": digest, "at": at}, ensure_ascii=False)
+        with self._lock:
+            self._done[key] = (digest, at)
+            try:
+                self.store.append(line)
+            except OSError as e:
+                print(e)
+
+    def compact(self):
+        """
+        压缩日志，只保留有效期内的记录，每次运行结束时调用
+        @return:
+        """
+        expire_at = time.time() - self.ttl
+        with self._lock:
+            self._done = {k: v for k, v in self._done.items() if v[1] > expire_at}
+            try:
+                self.store.clear()
+                for key, (digest, at) in self._done.items():
+                    self.store.append(json.dumps({"key": key, "target": digest, "at": at}, ensure_ascii=False))
+            except OSError as e:
+                print(e)
+
+
+class Deadline:
+    def __init__(self, context, margin=DEADLINE_MARGIN):
+        """
+        函数执行时间的保护，剩余时间不足时停止提交新的任务，留出时间等待已提交的任务和保存进度
+        @param context: 函数的context
+        @param margin: 预留的时间(秒)
+        """
+        self.context = context
+        self.margin = margin
+        self.reached = False
+
+    def expired(self) -> bool:
+        if not self.reached and self.context.getRemainingTimeInMilliSeconds() < self.margin * 1000:
+            print("函数剩余执行时间不足，停止提交新的修改，下次运行继续")
+            self.reached = True
+        return self.reached
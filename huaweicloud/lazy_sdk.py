@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+
+import os
+import re
+import sys
+import types
+import importlib
+import importlib.util
+
+"""
+华为云SDK按需导入。
+huaweicloudsdkxxx.vN包和其model包的__init__会导入全部几百个model类，冷启动的大部分时间花在这里。
+install之后这两个包换成按需加载的模块，from huaweicloudsdkecs.v2 import UpdateServerRequest只会导入用到的类，
+客户端反序列化响应时通过model包按名称取类，同样按需导入。
+必须在导入对应的SDK包之前调用；环境变量HUAWEICLOUD_LAZY_SDK=0时不生效，用于对比。
+"""
+
+ENABLED = os.environ.get("HUAWEICLOUD_LAZY_SDK", "1") != "0"
+
+_ACRONYM = re.compile(r"([A-Z]+)([A-Z][a-z])")
+_CAMEL = re.compile(r"([a-z0-9])([A-Z])")
+
+
+def _snake(name) -> str:
+    # UpdateServerRequestBody => update_server_request_body，ASICAcceleratorInfo => asic_accelerator_info，与SDK的文件命名一致
+    return _CAMEL.sub(r"\1_\2", _ACRONYM.sub(r"\1_\2", name)).lower()
+
+
+def _load_model(module, name):
+    return getattr(importlib.import_module(f"{module.__name__}.{_snake(name)}"), name)
+
+
+def _load_package_attr(module, name):
+    if name.endswith("Client"):  # EcsClient => ecs_client
+        return getattr(importlib.import_module(f"{module.__name__}.{_snake(name)}"), name)
+    return getattr(sys.modules[f"{module.__name__}.model"], name)
+
+
+class _LazyModule(types.ModuleType):
+    def __init__(self, name, path, init_file, load_attr):
+        """
+        @param name: 模块名
+        @param path: 包的目录
+        @param init_file: 原始的__init__.py
+        @param load_attr: 按名称加载属性的函数 (module, name) => value，加载失败抛出ImportError
+        """
+        super().__init__(name)
+        self.__path__ = path
+        self.__package__ = name
+        self.__file__ = init_file
+        self._load_attr = load_attr
+        self._real = None
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in ("_real", "_load_attr"):
+            raise AttributeError(name)
+        try:
+            value = self._load_attr(self, name)
+        except ImportError:
+            value = self._load_real(name)  # 命名不符合规则的类，退回执行原始的__init__
+        setattr(self, name, value)
+        return value
+
+    def _load_real(self, name):
+        if self._real is None:
+            spec = importlib.util.spec_from_file_location(self.__name__, self.__file__,
+                                                          submodule_search_locations=self.__path__)
+            real = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(real)
+            self._real = real
+        try:
+            return getattr(self._real, name)
+        except AttributeError:
+            raise AttributeError(f"module {self.__name__!r} has no attribute {name!r}")
+
+
+def install(*packages):
+    """
+    将SDK包替换为按需加载的模块，已经导入过的包不处理
+    @param packages: 如huaweicloudsdkecs.v2 huaweicloudsdkrms.v1
+    @return:
+    """
+    if not ENABLED:
+        return
+    for package in packages:
+        if package in sys.modules:
+            continue
+        spec = importlib.util.find_spec(package)  # 只查找不执行包的__init__
+        if spec is None:
+            raise ImportError(f"No module named {package!r}")
+        path = list(spec.submodule_search_locations)
+        models_path = os.path.join(path[0], "model")
+        models = _LazyModule(f"{package}.model", [models_path], os.path.join(models_path, "__init__.py"),
+                             _load_model)
+        module = _LazyModule(package, path, spec.origin, _load_package_attr)
+        module.model = models
+        sys.modules[f"{package}.model"] = models
+        sys.modules[package] = module
+        parent_name, _, child = package.rpartition(".")
+        setattr(sys.modules[parent_name], child, module)
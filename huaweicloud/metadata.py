@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+
+import lazy_sdk
+
+lazy_sdk.install("huaweicloudsdkeps.v1", "huaweicloudsdkiam.v3")
+
+from huaweicloudsdkcore.exceptions import exceptions
+from huaweicloudsdkeps.v1 import ListEnterpriseProjectRequest
+from huaweicloudsdkiam.v3 import KeystoneListAuthProjectsRequest
+
+from cache import PersistentCache, account_key
+
+import threading
+
+"""
+企业项目和IAM项目的元数据缓存。两者很少变化，翻页拉取一次后持久化到/tmp，过期前的运行不再调用EPS和IAM，
+并建立id->名称、名称->id两个方向的索引，按名称查找企业项目不再逐个遍历。
+按名称查找不到时(缓存之后新建的企业项目)重新拉取一次。
+"""
+
+METADATA_TTL = 3600  # 元数据缓存的过期时间(秒)，可在函数的环境变量metadata_ttl中覆盖
+EPS_PAGE_LIMIT = 1000  # ListEnterpriseProject每页最大1000
+
+
+class ProjectIndex:
+    def __init__(self, projects):
+        """
+        @param projects: {id: name}
+        """
+        self.by_id = dict(projects)
+        self.by_name = {name: project_id for project_id, name in self.by_id.items()}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def name_of(self, project_id):
+        return self.by_id.get(project_id)
+
+    def id_of(self, name):
+        return self.by_name.get(name)
+
+
+class MetadataCache:
+    def __init__(self, eps_client, iam_client, ak, ttl=METADATA_TTL):
+        """
+        @param eps_client: eps client，目前只能是cn-north-4
+        @param iam_client: iam client，全局
+        @param ak: access key，用于区分不同账号的缓存
+        @param ttl: 缓存过期时间(秒)
+        """
+        self.eps_client = eps_client
+        self.iam_client = iam_client
+        self.cache = PersistentCache("metadata_" + account_key(ak), ttl)
+        self._indexes = {}  # {key: ProjectIndex}
+        self._refreshed = set()  # 本次运行已重新拉取过的key，按名称查找不到时只重拉一次
+        self._lock = threading.Lock()
+
+    def _index(self, key, fetch, refresh=False) -> ProjectIndex:
+        with self._lock:
+            if not refresh and key in self._indexes:
+                return self._indexes[key]
+            projects = None if refresh else self.cache.get(key)
+            if projects is None:
+                projects = fetch()
+                if projects is None:  # 请求失败，不写缓存，下次运行重试
+                    projects = {}
+                else:
+                    self.cache.set(key, projects)
+            self._indexes[key] = ProjectIndex(projects)
+            return self._indexes[key]
+
+    def enterprise_projects(self, refresh=False) -> ProjectIndex:
+        """
+        所有企业项目
+        @param refresh: 忽略缓存重新拉取
+        @return: ProjectIndex {ep_id: ep_name}
+        """
+        return self._index("enterprise_projects", self._fetch_enterprise_projects, refresh)
+
+    def iam_projects(self, refresh=False) -> ProjectIndex:
+        """
+        IAM用户可以访问的项目(已启用)
+        @param refresh: 忽略缓存重新拉取
+        @return: ProjectIndex {project_id: region_name}
+        """
+        return self._index("iam_projects", self._fetch_iam_projects, refresh)
+
+    def enterprise_project_id(self, name):
+        """
+        按名称查找企业项目，缓存中没有时重新拉取一次
+        @param name: 企业项目名称
+        @return: ep_id，不存在返回None
+        """
+        ep_id = self.enterprise_projects().id_of(name)
+        if ep_id is None and "enterprise_projects" not in self._refreshed:
+            self._refreshed.add("enterprise_projects")
+            ep_id = self.enterprise_projects(refresh=True).id_of(name)
+        return ep_id
+
+    def project_id(self, region_name):
+        """
+        @param region_name: 区域名，如cn-southwest-2
+        @return: 该区域的IAM项目id
+        """
+        return self.iam_projects().id_of(region_name)
+
+    def _fetch_enterprise_projects(self):
+        try:
+            enterprise_projects = {}
+            request = ListEnterpriseProjectRequest()
+            request.limit = EPS_PAGE_LIMIT
+            request.offset = 0
+            while True:
+                response = self.eps_client.list_enterprise_project(request).to_dict()
+                page = response.get("enterprise_projects") or []
+                for info in page:
+                    enterprise_projects[info.get("id")] = info.get("name")
+                request.offset += len(page)
+                if len(page) < EPS_PAGE_LIMIT or request.offset >= (response.get("total_count") or 0):
+                    return enterprise_projects
+
+        except exceptions.ClientRequestException as e:
+            print(e.status_code)
+            print(e.error_code)
+            print(e.error_msg)
+
+    def _fetch_iam_projects(self):
+        try:
+            projects = {}
+            request = KeystoneListAuthProjectsRequest()
+            response = self.iam_client.keystone_list_auth_projects(request).to_dict().get("projects") or []
+            for info in response:
+                if info.get("enabled") == True:
+                    projects[info.get("id")] = info.get("name")
+            return projects
+
+        except exceptions.ClientRequestException as e:
+            print(e.status_code)
+            print(e.error_code)
+            print(e.error_msg)
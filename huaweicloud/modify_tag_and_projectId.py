@@ -1,70 +1,53 @@
 # -*- coding:utf-8 -*-
 
-from huaweicloudsdkcore.auth.credentials import GlobalCredentials, BasicCredentials
+import lazy_sdk
+
+lazy_sdk.install("huaweicloudsdkeps.v1", "huaweicloudsdkevs.v2", "huaweicloudsdkeip.v2", "huaweicloudsdkrms.v1")
+
 from huaweicloudsdkcore.exceptions import exceptions
-from huaweicloudsdkeps.v1.region.eps_region import EpsRegion
-from huaweicloudsdkevs.v2.region.evs_region import EvsRegion
-from huaweicloudsdkeip.v2.region.eip_region import EipRegion
-from huaweicloudsdkrms.v1.region.rms_region import RmsRegion
-from huaweicloudsdkiam.v3.region.iam_region import IamRegion
-
-from huaweicloudsdkeps.v1 import *
-from huaweicloudsdkevs.v2 import *
-from huaweicloudsdkeip.v2 import *
-from huaweicloudsdkrms.v1 import *
-from huaweicloudsdkiam.v3 import *
-
-import multiprocessing
+
+from huaweicloudsdkeps.v1 import MigrateResourceRequest, MigrateResource
+from huaweicloudsdkevs.v2 import EvsClient, BatchCreateVolumeTagsRequest, BatchCreateVolumeTagsRequestBody, Tag
+from huaweicloudsdkeip.v2 import EipClient, BatchCreatePublicipTagsRequest, BatchCreatePublicipTagsRequestBody, \
+    ResourceTagOption
+
+from clients import ClientRegistry
+from inventory import RmsInventory, INVENTORY_TTL
+from throttle import MAX_WORKERS
+from changes import ChangeTracker
+from journal import Journal, Deadline
+from graph import InventoryGraph
+from metadata import MetadataCache, METADATA_TTL
+from tag_planner import TagPlanner, create_resource_tags
+
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 class HuaWeiCloudTask:
-    def __init__(self, ak: str, sk: str, max_workers: int):
+    def __init__(self, ak: str, sk: str, max_workers: int, inventory_ttl: int = INVENTORY_TTL,
+                 incremental: bool = True, metadata_ttl: int = METADATA_TTL):
         self.ak = ak
         self.sk = sk
         self.max_workers = max_workers
-        self.basic_credentials = BasicCredentials(ak, sk)
-        self.global_credentials = GlobalCredentials(ak, sk)
+        self.clients = ClientRegistry(ak, sk)
 
         # 此处目前只能填cn-north-4
-        self.eps_client = EpsClient.new_builder() \
-            .with_credentials(self.global_credentials) \
-            .with_region(EpsRegion.value_of("cn-north-4")) \
-            .build()
+        self.eps_client = self.clients.get("eps", "cn-north-4")
 
         # cn-southwest-2 随意填写，全局的
-        self.iam_client = IamClient.new_builder() \
-            .with_credentials(self.global_credentials) \
-            .with_region(IamRegion.value_of("cn-southwest-2")) \
-            .build()
+        self.iam_client = self.clients.get("iam", "cn-southwest-2")
 
         # 此处目前只能填cn-north-4
-        self.rms_client = RmsClient.new_builder() \
-            .with_credentials(self.global_credentials) \
-            .with_region(RmsRegion.value_of("cn-north-4")) \
-            .build()
+        self.rms_client = self.clients.get("rms", "cn-north-4")
 
-    def get_iam_region(self):
-        """
-        查询IAM用户可以访问的项目列表
-        @return: {region_name: region_id}
-        """
-        try:
-            data = {}
-            request = KeystoneListAuthProjectsRequest()
-            response = self.iam_client.keystone_list_auth_projects(request).to_dict().get("projects")
-            for info in response:
-                if info.get("enabled") == True:
-                    iam_id = info.get("id")
-                    iam_name = info.get("name")
-                    data[iam_name] = iam_id
-            return data
-
-        except exceptions.ClientRequestException as e:
-            print(e.status_code)
-            print(e.error_code)
-            print(e.error_msg)
+        # 全局服务，批量添加标签
+        self.tms_client = self.clients.get("tms", "cn-north-4")
+        self.inventory = RmsInventory(self.rms_client, ak, inventory_ttl)
+        self.changes = ChangeTracker(ak, "modify_tag_and_projectId", incremental)
+        self.journal = Journal(ak, "modify_tag_and_projectId", inventory_ttl)
+        self.graph = InventoryGraph()
+        self.metadata = MetadataCache(self.eps_client, self.iam_client, ak, metadata_ttl)
 
     def migrate_project(self, enterprise_project_id, resource_id, project_id):
         """
@@ -84,168 +67,49 @@ class HuaWeiCloudTask:
                 project_id=project_id
             )
             response = self.eps_client.migrate_resource(request)
+            self.journal.record("ep:" + resource_id, enterprise_project_id)
 
         except exceptions.ClientRequestException as e:
             print(e.status_code)
             print(e.error_code)
             print(e.error_msg)
 
-    def get_all_enterprise_projects(self):
+    def iter_servers(self, resources):
         """
-        获取所有的企业项目
-        @return: {ep_id: ep_name}
+        解析ecs，同时加入graph
+        @param resources: rms资源的迭代器，可以是inventory.stream边拉取边解析
+        @return: 运行中的Server
         """
-        try:
-            enterprise_projects = {}
-            request = ListEnterpriseProjectRequest()
-            # request.status = 1  # 1启用 2停用
-            response = self.eps_client.list_enterprise_project(request).to_dict().get("enterprise_projects")
-            for info in response:
-                enterprise_project_id = info.get("id")
-                name = info.get("name")
-                enterprise_projects[enterprise_project_id] = name
-            return enterprise_projects
+        for server in self.graph.stream("ecs.cloudservers", resources):
+            if server.status == "ACTIVE":
+                yield server
 
-        except exceptions.ClientRequestException as e:
-            print(e.status_code)
-            print(e.error_code)
-            print(e.error_msg)
-
-    def get_all_servers(self):
+    def iter_volumes(self, resources):
         """
-        获取所有的ecs
-        @return: {"ecs_id": {"region_id": region_id, "public_ip":public_ip, "tags": tags, "ep_id": ep_id}}
+        解析磁盘，同时加入graph
+        @param resources: rms资源的迭代器
+        @return: 使用中的Volume
         """
-        marker = None
-        data = {}
-        request = ListAllResourcesRequest()
-        request.limit = 200  # 目前最大200
-        request.type = "ecs.cloudservers"
-        while True:
-            try:
-                request.marker = marker
-                response = self.rms_client.list_all_resources(request).to_dict()
-                if response:
-                    page_info = response.get("page_info")
-                    next_marker = page_info.get("next_marker")
-                    resources_list = response.get("resources")
-                    for info in resources_list:
-                        properties = info.get("properties")
-                        if properties.get("status") == "ACTIVE":
-                            region_id = info.get("region_id")
-                            ecs_id = info.get("id")
-                            tags = info.get("tags")
-                            ep_id = info.get("ep_id")
-                            public_ip = properties.get("addresses")[1].get("addr") if len(
-                                properties.get("addresses")) > 1 else None
-                            tmp = {
-                                "region_id": region_id,
-                                "public_ip": public_ip,
-                                "tags": tags,
-                                "ep_id": ep_id
-                            }
-                            if ecs_id in data:
-                                data[ecs_id].update(tmp)
-                            else:
-                                data[ecs_id] = tmp
-                    if next_marker:
-                        marker = next_marker
-                    else:
-                        return data
-                else:
-                    return data
+        for volume in self.graph.stream("evs.volumes", resources):
+            if volume.status == "in-use":
+                yield volume
 
-            except exceptions.ClientRequestException as e:
-                print(e.status_code)
-                print(e.error_code)
-                print(e.error_msg)
-
-    def get_all_volumes(self):
+    def get_all_servers(self):
         """
-        获取所有的磁盘
-        @return: {"evs_id": {"ecs_id": ecs_id, "tags": tags, "region_id": region_id}}
+        获取所有运行中的ecs，已经拉取过的直接从graph读取
+        @return: [Server]
         """
-        marker = None
-        data = {}
-        request = ListAllResourcesRequest()
-        request.limit = 200  # 目前最大200
-        request.type = "evs.volumes"
-        while True:
-            try:
-                request.marker = marker
-                response = self.rms_client.list_all_resources(request).to_dict()
-                if response:
-                    page_info = response.get("page_info")
-                    next_marker = page_info.get("next_marker")
-                    resources_list = response.get("resources")
-                    for info in resources_list:
-                        properties = info.get("properties")
-                        if properties.get("status") == "in-use":
-                            region_id = info.get("region_id")
-                            evs_id = info.get("id")
-                            tags = info.get("tags")
-                            ecs_id = properties.get("attachments")[0].get("serverId")
-                            tmp = {
-                                "ecs_id": ecs_id,
-                                "tags": tags,
-                                "region_id": region_id
-                            }
-                            if evs_id in data:
-                                data[evs_id].update(tmp)
-                            else:
-                                data[evs_id] = tmp
-                    if next_marker:
-                        marker = next_marker
-                    else:
-                        return data
-                else:
-                    return data
-
-            except exceptions.ClientRequestException as e:
-                print(e.status_code)
-                print(e.error_code)
-                print(e.error_msg)
+        servers = self.graph.all("ecs.cloudservers")
+        if not servers:
+            return list(self.iter_servers(self.inventory.list_resources("ecs.cloudservers")))
+        return [i for i in servers if i.status == "ACTIVE"]
 
     def get_all_eips(self):
         """
-        获取所有的公网ip
-        @return: {"public_ip": tags}
+        获取所有的公网ip并加入graph，按公网ip通过graph.public_ip查找
+        @return: [PublicIp]
         """
-        marker = None
-        data = {}
-        request = ListAllResourcesRequest()
-        request.limit = 200  # 目前最大200
-        request.type = "vpc.publicips"
-        while True:
-            try:
-                request.marker = marker
-                response = self.rms_client.list_all_resources(request).to_dict()
-                if response:
-                    page_info = response.get("page_info")
-                    next_marker = page_info.get("next_marker")
-                    resources_list = response.get("resources")
-                    for info in resources_list:
-                        properties = info.get("properties")
-                        # # 只获取使用中和绑定服务器的
-                        # if properties.get("associateInstanceType") == "PORT" and properties.get("status") == "ACTIVE":
-                        eip_id = info.get("id")
-                        tags = dict(info.get("tags"))
-                        public_ip = properties.get("publicIpAddress")
-                        tmp = {"eip_id": eip_id}
-                        tags.update(tmp)
-                        tmp = {public_ip: tags}
-                        data.update(tmp)
-                    if next_marker:
-                        marker = next_marker
-                    else:
-                        return data
-                else:
-                    return data
-
-            except exceptions.ClientRequestException as e:
-                print(e.status_code)
-                print(e.error_code)
-                print(e.error_msg)
+        return list(self.graph.stream("vpc.publicips", self.inventory.list_resources("vpc.publicips")))
 
     def update_ip_tag(self, client: EipClient, eip_id, tags):
         """
@@ -265,6 +129,8 @@ class HuaWeiCloudTask:
                 tags=listResourceTagOptionTagsbody
             )
             response = client.batch_create_publicip_tags(request)
+            self.journal.record("eip:" + eip_id, tags)
+            return True
         except exceptions.ClientRequestException as e:
             print(e.status_code)
             print(e.error_code)
@@ -288,108 +154,175 @@ class HuaWeiCloudTask:
                 action="create"
             )
             response = client.batch_create_volume_tags(request)
+            self.journal.record("evs:" + volume_id, tags)
+            return True
         except exceptions.ClientRequestException as e:
             print(e.status_code)
             print(e.error_code)
             print(e.error_msg)
 
-    def migrate_project_job(self, all_servers):
+    def apply_tag_batch(self, batch):
+        """
+        提交一批需要补充相同标签的资源，多个资源时走TMS批量接口，失败的资源逐个调用eip/evs的标签接口
+        @param batch: TagBatch
+        @return: 修改成功的资源数
+        """
+        failed = set(batch.resource_ids)
+        project_id = self.metadata.project_id(batch.region_id)
+        if len(batch.resource_ids) > 1 and project_id:
+            try:
+                failed = create_resource_tags(self.tms_client, project_id, batch)
+                for resource_id in batch.resource_ids:
+                    if resource_id not in failed:
+                        self.journal.record(batch.kind + ":" + resource_id, batch.tags)
+            except exceptions.ClientRequestException as e:
+                print(e.status_code)
+                print(e.error_code)
+                print(e.error_msg)
+
+        count = len(batch.resource_ids) - len(failed)
+        for resource_id in failed:
+            if batch.kind == "eip":
+                ok = self.update_ip_tag(self.clients.get("eip", batch.region_id), resource_id, batch.tags)
+            else:
+                ok = self.update_volume_tag(self.clients.get("evs", batch.region_id), resource_id, batch.tags)
+            count += bool(ok)
+        return count
+
+    def migrate_project_job(self, all_servers, deadline=None):
         """
         迁移企业项目任务
-        @param all_servers: ecs字典
+        @param all_servers: [Server]
+        @param deadline: Deadline，剩余时间不足时停止提交
         @return:
         """
-        all_regions = self.get_iam_region()
-        enterprise_projects = self.get_all_enterprise_projects()  
+        enterprise_projects = self.metadata.enterprise_projects()
         res = []
 
         with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            for ecs_id, info in all_servers.items():
-                ep_id = info.get("ep_id")
-                tags = info.get("tags")
-                region_name = info.get("region_id")
+            for server in all_servers:
+                if deadline and deadline.expired():
+                    break
+                ecs_id = server.id
+                ep_id = server.ep_id
+                tags = server.tags
+                region_name = server.region_id
                 ecs_prj_name = tags.get("projectname") if "projectname" in tags else None  #projectname为你自定义的标签key
-                if ecs_prj_name and enterprise_projects[ep_id] != ecs_prj_name:  # 如企业项目对不上标签的体系
-                    new_prj_id = list(filter(lambda x: enterprise_projects[x] == ecs_prj_name, enterprise_projects))[0]
-                    region_id = all_regions.get(region_name)
+                change_key = "ep:" + ecs_id
+                if not self.changes.is_changed(change_key, ep_id, enterprise_projects.name_of(ep_id), ecs_prj_name):
+                    continue
+                if ecs_prj_name and enterprise_projects.name_of(ep_id) != ecs_prj_name:  # 如企业项目对不上标签的体系
+                    new_prj_id = self.metadata.enterprise_project_id(ecs_prj_name)
+                    if new_prj_id is None:
+                        print(f"企业项目{ecs_prj_name}不存在，跳过{ecs_id}")
+                        continue
+                    if self.journal.is_done(change_key, new_prj_id):  # 上次运行已迁移，清单缓存还未更新
+                        continue
+                    region_id = self.metadata.project_id(region_name)
                     future = executor.submit(self.migrate_project, enterprise_project_id=new_prj_id,
                                              resource_id=ecs_id, project_id=region_id)
                     res.append(future)
+                else:
+                    self.changes.mark_done(change_key)
         return res
 
-    def update_tag_job(self, all_servers, all_volumes, all_eips):
+    def update_tag_job(self, servers, volumes, deadline=None):
         """
-        更新标签任务
-        @param all_servers: ecs字典
-        @param all_volumes: evs字典
-        @param all_eips: eip字典
-        @return:
+        更新标签任务，边拉取边对比，需要补充的标签交给TagPlanner按相同的标签分组，
+        分组满一批(50个)时立即提交，不需要等ecs和evs全部拉取完成，对比结束后再提交剩余的分组。
+        公网ip需要先通过get_all_eips加入graph
+        @param servers: Server的迭代器
+        @param volumes: Volume的迭代器
+        @param deadline: Deadline，剩余时间不足时停止对比，已对比的仍然提交，修改记录在journal中，下次运行跳过
+        @return: 每批一个future，结果为修改成功的资源数
         """
+        planner = TagPlanner()
         res = []
-        eip_region = evs_region = None
         with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             # 更新eip
-            for info in all_servers.values():
-                public_ip = info.get("public_ip")
+            for server in servers:
+                if deadline and deadline.expired():
+                    break
+                public_ip = server.public_ip
                 if public_ip:
-                    ecs_tags = info.get("tags")
-                    eip_tags = all_eips.get(public_ip)
-                    eip_id = eip_tags.get("eip_id")
+                    ecs_tags = server.tags
+                    eip = self.graph.public_ip(public_ip)
+                    if eip is None:
+                        print(f"未找到公网ip {public_ip}")
+                        continue
+                    eip_tags = eip.tags
+                    eip_id = eip.id
+                    change_key = "eip:" + eip_id
+                    if not self.changes.is_changed(change_key, ecs_tags, eip_tags):
+                        continue
                     if ecs_tags:
                         eip_result = ecs_tags.items() - eip_tags.items()  # 对比公网IP是不是跟服务器的标签一样
-                        if eip_result:
-                            region_id = info.get("region_id")
-                            if eip_region != region_id:
-                                eip_region = region_id
-                                eip_client = EipClient.new_builder() \
-                                    .with_credentials(self.basic_credentials) \
-                                    .with_region(EipRegion.value_of(eip_region)) \
-                                    .build()
+                        if not eip_result:
+                            self.changes.mark_done(change_key)
+                        else:
                             need_update_tag = dict(eip_result)
-                            f1 = executor.submit(self.update_ip_tag, client=eip_client, eip_id=eip_id,
-                                                 tags=need_update_tag)
-                            res.append(f1)
+                            if self.journal.is_done(change_key, need_update_tag):
+                                continue
+                            batch = planner.add("eip", eip.region_id, eip_id, need_update_tag)
+                            if batch:  # 满一批立即提交，不等全部对比完
+                                res.append(executor.submit(self.apply_tag_batch, batch))
                     else:
                         print(public_ip)
 
             # 更新磁盘
-            for evs_id, info in all_volumes.items():
-                ecs_id = info.get("ecs_id")
-                evs_tags = info.get("tags")
-                ecs_tags = all_servers.get(ecs_id).get("tags") if all_servers.get(ecs_id) else None  # rms接口获取不到硬盘冻结信息
+            for volume in volumes:
+                if deadline and deadline.expired():  # 服务器没有全部拉取时无法对比标签，同样停止
+                    break
+                evs_id = volume.id
+                evs_tags = volume.tags
+                server = self.graph.server(volume.server_id)  # 服务器已经全部拉取并加入graph
+                ecs_tags = server.tags if server and server.status == "ACTIVE" else None  # rms接口获取不到硬盘冻结信息
+                change_key = "evs:" + evs_id
+                if not self.changes.is_changed(change_key, ecs_tags, evs_tags):
+                    continue
                 if ecs_tags:
                     evs_result = ecs_tags.items() - evs_tags.items()  # 对比硬盘是不是跟服务器的标签一样
-                    if evs_result:
-                        region_id = info.get("region_id")
-                        if evs_region != region_id:
-                            evs_region = region_id
-                            evs_client = EvsClient.new_builder() \
-                                .with_credentials(self.basic_credentials) \
-                                .with_region(EvsRegion.value_of(evs_region)) \
-                                .build()
+                    if not evs_result:
+                        self.changes.mark_done(change_key)
+                    else:
                         need_update_tag = dict(evs_result)
-                        f2 = executor.submit(self.update_volume_tag, client=evs_client, volume_id=evs_id,
-                                             tags=need_update_tag)
-                        res.append(f2)
+                        if self.journal.is_done(change_key, need_update_tag):
+                            continue
+                        batch = planner.add("evs", volume.region_id, evs_id, need_update_tag)
+                        if batch:
+                            res.append(executor.submit(self.apply_tag_batch, batch))
+
+            for batch in planner.batches():  # 剩余不满一批的分组
+                res.append(executor.submit(self.apply_tag_batch, batch))
+            print(f"需要修改标签的资源{planner.total}个，分为{len(res)}批")
         return res
 
 
 def handler(event, context):
     ak = context.getAccessKey()
     sk = context.getSecretKey()
-    max_workers = multiprocessing.cpu_count() * 4  # 线程池任务最大数量
-
-    task = HuaWeiCloudTask(ak, sk, max_workers)
-    all_servers = task.get_all_servers()
-    all_volumes = task.get_all_volumes()
-    all_eips = task.get_all_eips()
-    t_jobs = task.update_tag_job(all_servers, all_volumes, all_eips)
-    t_result = [i.result() for i in as_completed(t_jobs) if i.result() is None]
-    print(f"修改标签{len(t_result)}个")
-
-    m_jobs = task.migrate_project_job(all_servers)
-    m_result = [i.result() for i in as_completed(m_jobs) if i.result() is None]
-    print(f"迁移企业项目{len(m_result)}个")
+    max_workers = int(context.getUserData("max_workers") or MAX_WORKERS)  # 线程池大小，实际并发由throttle按限流情况调整
+    inventory_ttl = int(context.getUserData("inventory_ttl") or INVENTORY_TTL)
+    incremental = context.getUserData("full_scan") != "true"  # full_scan=true时全量检查所有资源
+    metadata_ttl = int(context.getUserData("metadata_ttl") or METADATA_TTL)
+
+    task = HuaWeiCloudTask(ak, sk, max_workers, inventory_ttl, incremental, metadata_ttl)
+    deadline = Deadline(context)
+    # 三种资源同时在后台开始拉取，ecs和evs边拉取边提交修改，eip需要完整的字典按ip查找
+    servers = task.iter_servers(task.inventory.stream("ecs.cloudservers"))
+    volumes = task.iter_volumes(task.inventory.stream("evs.volumes"))
+    task.get_all_eips()  # 加入graph，按公网ip查找
+    t_jobs = task.update_tag_job(servers, volumes, deadline)
+    t_result = sum(i.result() for i in as_completed(t_jobs))
+    print(f"修改标签{t_result}个")
+
+    if not deadline.reached:  # 服务器没有全部拉取时不读清单，避免重新翻页
+        m_jobs = task.migrate_project_job(task.get_all_servers(), deadline)  # 已拉取完成，直接读graph
+        m_result = [i.result() for i in as_completed(m_jobs) if i.result() is None]
+        print(f"迁移企业项目{len(m_result)}个")
+    print(f"跳过未变化的资源{task.changes.unchanged}个，跳过上次已修改的{task.journal.skipped}个")
+    task.changes.save()
+    task.journal.compact()
     return {
         "statusCode": 200,
         "isBase64Encoded": False,
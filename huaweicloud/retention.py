@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+
+from datetime import datetime
+
+"""
+快照保留策略，按created_at排序后一次遍历算出每个磁盘需要删除的全部快照。
+支持保留最近N个，以及每天/每周/每月各保留最新的一个(按UTC时间分组)，满足任意一条规则的快照保留，其余删除。
+"""
+
+
+def parse_time(value) -> datetime:
+    """
+    解析快照的created_at，如2016-02-16T16:54:14.981520，精确到秒
+    @param value: created_at
+    @return: datetime
+    """
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+class RetentionPolicy:
+    def __init__(self, keep_last=0, daily=0, weekly=0, monthly=0):
+        """
+        所有规则都为0时不删除任何快照
+        @param keep_last: 保留最近的快照数
+        @param daily: 保留最近几天，每天最新的一个
+        @param weekly: 保留最近几周，每周最新的一个
+        @param monthly: 保留最近几个月，每月最新的一个
+        """
+        self.keep_last = keep_last
+        self.rules = [
+            (daily, lambda t: t.date()),
+            (weekly, lambda t: t.isocalendar()[:2]),
+            (monthly, lambda t: (t.year, t.month)),
+        ]
+
+    def __bool__(self):
+        return bool(self.keep_last or any(count for count, _ in self.rules))
+
+    def __str__(self):
+        daily, weekly, monthly = [count for count, _ in self.rules]
+        return f"keep_last={self.keep_last} daily={daily} weekly={weekly} monthly={monthly}"
+
+    def plan(self, snapshots, pending=None) -> list:
+        """
+        计算需要删除的快照
+        @param snapshots: 磁盘的快照 [{"id": id, "created_at": created_at}]，顺序任意
+        @param pending: 即将创建的快照的时间，作为最新的一个快照参与计算，为空时不预留
+        @return: 需要删除的快照，按created_at从新到旧
+        """
+        if not self:
+            return []
+        items = sorted(((parse_time(i.get("created_at")), i) for i in snapshots), key=lambda x: x[0], reverse=True)
+        if pending:
+            items.insert(0, (parse_time(pending), None))
+
+        seen = [set() for _ in self.rules]
+        delete = []
+        for index, (created_at, snapshot) in enumerate(items):
+            keep = index < self.keep_last
+            for (count, bucket), buckets in zip(self.rules, seen):
+                key = bucket(created_at)
+                if key not in buckets and len(buckets) < count:
+                    buckets.add(key)
+                    keep = True
+            if not keep and snapshot is not None:
+                delete.append(snapshot)
+        return delete
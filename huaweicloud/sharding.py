@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+
+import lazy_sdk
+
+lazy_sdk.install("huaweicloudsdkfunctiongraph.v2")
+
+from huaweicloudsdkcore.exceptions import exceptions
+from huaweicloudsdkfunctiongraph.v2 import InvokeFunctionRequest
+
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+任务分片：协调者把资源按区域或按id哈希分成多片，通过分发器交给多个工作者调用并行处理，再汇总各片的结果。
+分发器只需实现dispatch(events) -> [result]，结果与events顺序一致，某一片失败时结果为None。
+"""
+
+
+def partition_by_region(items, shards) -> list:
+    """
+    按区域分片，同一区域的资源在同一片中。资源多的区域优先放入当前最少的一片
+    @param items: {region: [item]}
+    @param shards: 分片数
+    @return: [{region: [item]}]，去掉空的分片
+    """
+    parts = [{} for _ in range(shards)]
+    sizes = [0] * shards
+    for region, values in sorted(items.items(), key=lambda x: len(x[1]), reverse=True):
+        index = sizes.index(min(sizes))
+        parts[index][region] = values
+        sizes[index] += len(values)
+    return [i for i in parts if i]
+
+
+def partition_by_hash(items, shards, key) -> list:
+    """
+    按资源id的哈希分片，各片数量接近，同一资源每次都落在同一片
+    @param items: {region: [item]}
+    @param shards: 分片数
+    @param key: 获取资源id的函数
+    @return: [{region: [item]}]，去掉空的分片
+    """
+    parts = [{} for _ in range(shards)]
+    for region, values in items.items():
+        for item in values:
+            index = int(hashlib.md5(key(item).encode("utf-8")).hexdigest(), 16) % shards
+            parts[index].setdefault(region, []).append(item)
+    return [i for i in parts if i]
+
+
+def partition(items, shards, by="region", key=None) -> list:
+    """
+    @param items: {region: [item]}
+    @param shards: 分片数
+    @param by: region或hash
+    @param key: by=hash时获取资源id的函数
+    @return: [{region: [item]}]
+    """
+    if by == "hash":
+        return partition_by_hash(items, shards, key)
+    return partition_by_region(items, shards)
+
+
+class LocalDispatcher:
+    def __init__(self, handler, context, max_workers=None):
+        """
+        在当前进程中用线程调用工作者的handler，用于测试和本地调试
+        @param handler: 工作者的handler(event, context)
+        @param context: 传给工作者的context
+        @param max_workers: 同时处理的分片数，默认全部同时
+        """
+        self.handler = handler
+        self.context = context
+        self.max_workers = max_workers
+
+    def _invoke(self, event):
+        try:
+            return self.handler(event, self.context)
+        except Exception as e:
+            print(e)
+
+    def dispatch(self, events) -> list:
+        with ThreadPoolExecutor(max_workers=self.max_workers or len(events) or 1) as executor:
+            return list(executor.map(self._invoke, events))
+
+
+class FunctionGraphDispatcher:
+    def __init__(self, client, function_urn, max_workers=None):
+        """
+        同步调用FunctionGraph函数处理每一片，协调者的超时时间需要不小于工作者
+        @param client: functiongraph client，与函数同一区域
+        @param function_urn: 工作者函数的urn，可以是协调者自己
+        @param max_workers: 同时调用的分片数，默认全部同时
+        """
+        self.client = client
+        self.function_urn = function_urn
+        self.max_workers = max_workers
+
+    def _invoke(self, event):
+        try:
+            request = InvokeFunctionRequest()
+            request.function_urn = self.function_urn
+            request.body = event
+            response = self.client.invoke_function(request)
+            if response.status != 200:
+                print(f"分片执行失败: {response.result}")
+                return None
+            return json.loads(response.result)
+        except exceptions.ClientRequestException as e:
+            print(e.status_code)
+            print(e.request_id)
+            print(e.error_code)
+            print(e.error_msg)
+        except (exceptions.SdkException, ValueError) as e:  # 超时、连接失败或返回的不是json
+            print(e)
+
+    def dispatch(self, events) -> list:
+        with ThreadPoolExecutor(max_workers=self.max_workers or len(events) or 1) as executor:
+            return list(executor.map(self._invoke, events))
@@ -0,0 +1,133 @@
+# -*- coding:utf-8 -*-
+
+import lazy_sdk
+
+lazy_sdk.install("huaweicloudsdkevs.v2")
+
+from huaweicloudsdkcore.exceptions import exceptions
+from huaweicloudsdkevs.v2 import ListSnapshotsRequest
+
+import time
+import threading
+
+"""
+快照完成情况跟踪。create_snapshot只是提交，快照变为available需要一段时间。
+后台线程按区域批量轮询：每个区域每轮只查询一次status=creating的快照，不在其中的即已结束，
+再按status=available和status=error查询区分可用和失败，其他状态继续跟踪。结束时统计每个快照的可用耗时、失败和超时未完成的快照。
+"""
+
+POLL_INTERVAL = 10  # 秒
+PAGE_LIMIT = 1000
+
+
+class SnapshotTracker:
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        """
+        @param poll_interval: 轮询间隔(秒)，可用耗时的精度
+        """
+        self.poll_interval = poll_interval
+        self._tracking = {}  # {region: {snapshot_id: (client, name, submitted_at)}}
+        self.available = {}  # {snapshot_id: (name, 可用耗时)}
+        self.failed = {}  # {snapshot_id: name}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+
+    def add(self, region, client, snapshot_id, name):
+        """
+        跟踪一个已提交创建的快照，第一次调用时启动后台轮询
+        @param region: 区域
+        @param client: 该区域的evs client
+        @param snapshot_id: 快照id
+        @param name: 快照名
+        @return:
+        """
+        with self._lock:
+            self._tracking.setdefault(region, {})[snapshot_id] = (client, name, time.time())
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def wait(self, timeout) -> dict:
+        """
+        等待所有快照结束或超时，停止轮询
+        @param timeout: 最长等待时间(秒)
+        @return: 统计结果 {"available": {id: (name, 耗时)}, "failed": {id: name}, "stragglers": {id: name}}
+        """
+        deadline = time.time() + timeout
+        while self.pending() and time.time() < deadline and self._alive():
+            time.sleep(min(1, max(0, deadline - time.time())))
+        self._stop.set()
+        with self._lock:
+            stragglers = {k: v[1] for i in self._tracking.values() for k, v in i.items()}
+        return {"available": dict(self.available), "failed": dict(self.failed), "stragglers": stragglers}
+
+    def _alive(self) -> bool:
+        """
+        轮询线程是否还在运行，线程意外退出后不再等待
+        @return:
+        """
+        with self._lock:
+            alive = self._worker is not None and self._worker.is_alive()
+        if not alive:
+            print("快照轮询线程已退出，未完成的快照记为超时")
+        return alive
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(i) for i in self._tracking.values())
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            with self._lock:
+                regions = {k: dict(v) for k, v in self._tracking.items() if v}
+            for region, snapshots in regions.items():
+                try:
+                    self._poll(region, snapshots)
+                except exceptions.ClientRequestException as e:
+                    print(e.status_code)
+                    print(e.request_id)
+                    print(e.error_code)
+                    print(e.error_msg)
+                except exceptions.SdkException as e:  # 重试后仍然超时、连接失败或服务端错误，下一轮继续
+                    print(e)
+
+    def _poll(self, region, snapshots):
+        client = next(iter(snapshots.values()))[0]
+        now = time.time()
+        creating = self._list_ids(client, "creating")
+        # 刚提交的快照可能还没出现在列表中，至少等一个轮询间隔再判断
+        finished = [k for k, v in snapshots.items() if k not in creating and now - v[2] >= self.poll_interval]
+        if not finished:
+            return
+        available = self._list_ids(client, "available")
+        rest = [i for i in finished if i not in available]
+        errors = self._list_ids(client, "error") if rest else set()
+        with self._lock:
+            for snapshot_id in finished:
+                if snapshot_id in available:
+                    _, name, submitted_at = self._tracking[region].pop(snapshot_id)
+                    self.available[snapshot_id] = (name, now - submitted_at)
+                elif snapshot_id in errors:
+                    self.failed[snapshot_id] = self._tracking[region].pop(snapshot_id)[1]
+                # 其他状态(deleting、error_deleting或已不存在)继续跟踪，到最后仍未确定的记为超时未完成
+
+    @staticmethod
+    def _list_ids(client, status) -> set:
+        """
+        获取区域中某种状态的所有快照id
+        @param client: evs client
+        @param status: creating error等
+        @return: {snapshot_id}
+        """
+        ids = set()
+        request = ListSnapshotsRequest()
+        request.status = status
+        request.limit = PAGE_LIMIT
+        request.offset = 0
+        while True:
+            snapshots = client.list_snapshots(request).to_dict().get("snapshots") or []
+            ids.update(i.get("id") for i in snapshots)
+            if len(snapshots) < PAGE_LIMIT:
+                return ids
+            request.offset += PAGE_LIMIT
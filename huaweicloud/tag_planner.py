@@ -0,0 +1,85 @@
+# -*- coding:utf-8 -*-
+
+import lazy_sdk
+
+lazy_sdk.install("huaweicloudsdktms.v1")
+
+from huaweicloudsdktms.v1 import CreateResourceTagRequest, ReqCreateTag, ResourceTagBody, CreateTagRequest
+
+from typing import NamedTuple
+
+"""
+标签修改计划。收集每个资源需要补充的标签，按(资源类型, 区域, 标签)分组，某个分组满50个资源时立即作为一批返回提交，
+对比结束后再提交剩余不满一批的分组。同一批资源通过TMS的批量添加标签接口一次提交，每次最多50个资源、10个标签。
+标签策略调整后整批资源的修改只需要几十次调用，批量接口失败的资源再逐个调用各服务的标签接口。
+"""
+
+TMS_MAX_RESOURCES = 50  # CreateResourceTag每次最多50个资源
+TMS_MAX_TAGS = 10  # 每次最多10个标签
+TMS_RESOURCE_TYPES = {"eip": "eip", "evs": "disk"}  # 任务中的资源类型: TMS的资源类型
+
+
+class TagBatch(NamedTuple):
+    kind: str  # eip evs
+    region_id: str
+    tags: dict
+    resource_ids: list
+
+
+class TagPlanner:
+    def __init__(self, max_resources=TMS_MAX_RESOURCES):
+        """
+        @param max_resources: 每批的最大资源数
+        """
+        self.max_resources = max_resources
+        self._groups = {}  # {(kind, region_id, 标签): [resource_id]}，未满一批的资源
+        self.total = 0  # 加入的资源总数
+
+    def add(self, kind, region_id, resource_id, tags):
+        """
+        @param kind: eip evs
+        @param region_id: 资源所在区域
+        @param resource_id: 资源id
+        @param tags: 需要补充的标签 {key: value}
+        @return: 分组满一批时返回TagBatch，否则返回None
+        """
+        key = (kind, region_id, tuple(sorted(tags.items())))
+        resource_ids = self._groups.setdefault(key, [])
+        resource_ids.append(resource_id)
+        self.total += 1
+        if len(resource_ids) >= self.max_resources:
+            del self._groups[key]
+            return TagBatch(kind, region_id, dict(tags), resource_ids)
+        return None
+
+    def batches(self) -> list:
+        """
+        取出剩余不满一批的分组
+        @return: [TagBatch]，资源多的分组在前
+        """
+        batches = []
+        for (kind, region_id, tags), resource_ids in sorted(self._groups.items(), key=lambda x: -len(x[1])):
+            for i in range(0, len(resource_ids), self.max_resources):
+                batches.append(TagBatch(kind, region_id, dict(tags), resource_ids[i:i + self.max_resources]))
+        self._groups = {}
+        return batches
+
+
+def create_resource_tags(client, project_id, batch) -> set:
+    """
+    通过TMS批量添加标签，标签超过10个时分多次提交
+    @param client: tms client
+    @param project_id: 资源所在区域的项目id
+    @param batch: TagBatch
+    @return: 添加失败的资源id，整个请求失败时抛出异常
+    """
+    resources = [ResourceTagBody(resource_id=i, resource_type=TMS_RESOURCE_TYPES[batch.kind])
+                 for i in batch.resource_ids]
+    tags = [CreateTagRequest(key=k, value=v) for k, v in batch.tags.items()]
+    failed = set()
+    for i in range(0, len(tags), TMS_MAX_TAGS):
+        request = CreateResourceTagRequest()
+        request.body = ReqCreateTag(project_id=project_id, resources=resources, tags=tags[i:i + TMS_MAX_TAGS])
+        response = client.create_resource_tag(request).to_dict()
+        failed.update(item.get("resource_id") for item in response.get("failed_resources") or [])
+    return failed
@@ -0,0 +1,49 @@
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from journal import Journal, JournalStore
+
+
+class MemoryJournalStore(JournalStore):
+    def __init__(self, lines):
+        self.lines = list(lines)
+
+    def read(self) -> list:
+        return list(self.lines)
+
+    def append(self, line):
+        self.lines.append(line)
+
+    def clear(self):
+        self.lines = []
+
+
+def test_skips_malformed_lines():
+    now = time.time()
+    store = MemoryJournalStore([
+        json.dumps({"key": "ecs:1", "target": "x"}),  # 没有at
+        json.dumps({"key": "ecs:2", "target": "x", "at": None}),
+        json.dumps({"target": "x", "at": now}),  # 没有key
+        json.dumps(["ecs:3", now]),
+        json.dumps("ecs:4"),
+        '{"key": "ecs:5", "tar',  # 半行
+        json.dumps({"key": "ecs:6", "target": "x", "at": now - 3600}),  # 已过期
+    ])
+    journal = Journal("ak", "test", ttl=600, store=store)
+    assert journal._done == {}
+
+
+def test_keeps_valid_lines_next_to_malformed_ones():
+    store = MemoryJournalStore([json.dumps({"key": "ecs:1"})])
+    Journal("ak", "test", ttl=600, store=store).record("ecs:2", "new-name")
+
+    journal = Journal("ak", "test", ttl=600, store=store)
+    assert journal.is_done("ecs:2", "new-name")
+    assert not journal.is_done("ecs:2", "other-name")
+    assert not journal.is_done("ecs:1")
@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+
+from huaweicloudsdkcore.exceptions import exceptions
+
+import time
+import random
+import functools
+import threading
+
+"""
+接口限流，每个(服务, 区域)一个令牌桶控制请求速率，并发数按AIMD调整：
+请求成功时缓慢增加，被限流(429)时减半，被限流的请求按带抖动的指数退避重试。
+ClientRegistry返回的客户端已经包装好，所有接口调用都会经过这里，线程池大小只是并发的上限。
+"""
+
+MAX_WORKERS = 64  # 任务线程池的大小，实际并发由各(服务, 区域)的AIMD并发数决定
+
+DEFAULT_RATE = 20  # 每秒请求数
+SERVICE_RATES = {"rms": 10, "eps": 5, "iam": 5, "tms": 5}  # 全局服务所有区域共用配额，速率低一些
+
+INITIAL_CONCURRENCY = 8
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # 秒
+BACKOFF_CAP = 20  # 秒
+
+THROTTLE_ERROR_CODES = {"APIGW.0308", "APIG.0308"}  # API网关流控
+READ_PREFIXES = ("list_", "show_", "keystone_list_", "keystone_show_")  # 只读接口，服务端错误和超时也可以重试
+
+_throttles = {}  # {(service, region): Throttle}
+_throttles_lock = threading.Lock()
+
+
+def is_throttled(e) -> bool:
+    return isinstance(e, exceptions.ClientRequestException) and (e.status_code == 429 or
+                                                                 e.error_code in THROTTLE_ERROR_CODES)
+
+
+def is_transient(e) -> bool:
+    return isinstance(e, (exceptions.ServerResponseException, exceptions.ConnectionException,
+                          exceptions.RequestTimeoutException))
+
+
+def backoff(attempt) -> float:
+    """
+    带抖动的指数退避(full jitter)，避免被限流的请求同时重试
+    @param attempt: 第几次重试，从1开始
+    @return: 等待的秒数
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        """
+        令牌桶，线程安全
+        @param rate: 每秒生成的令牌数
+        @param burst: 桶的容量，默认等于rate
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        取一个令牌，没有令牌时等待。令牌数可以为负，表示已经预约了之后的令牌，按预约顺序等待
+        @return:
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AimdLimiter:
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        """
+        AIMD并发控制：并发打满时每次成功增加1/limit(每轮并发约加1)，被限流时减半
+        @param initial: 初始并发数
+        @param minimum: 最小并发数
+        @param maximum: 最大并发数
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> float:
+        """
+        占用一个并发，已满时等待
+        @return: 开始时间，release时传回
+        """
+        with self._cond:
+            while self._in_flight >= max(self.minimum, int(self.limit)):
+                self._cond.wait()
+            self._in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, success, throttled=False):
+        """
+        @param started: acquire返回的开始时间
+        @param success: 请求成功，增加并发数
+        @param throttled: 被限流，并发数减半。上次减半之前发出的请求已经按旧的并发数计算过，不再减半
+        @return:
+        """
+        with self._cond:
+            saturated = self._in_flight >= int(self.limit)
+            self._in_flight -= 1
+            if success:
+                if saturated:  # 并发没有用满时增加并发数没有意义
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif throttled and started > self._last_decrease:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = time.monotonic()
+            self._cond.notify_all()
+
+
+class Throttle:
+    def __init__(self, rate):
+        """
+        @param rate: 每秒请求数
+        """
+        self.bucket = TokenBucket(rate)
+        self.limiter = AimdLimiter()
+        self.throttled = 0  # 被限流的次数
+
+    def call(self, func, *args, retry_transient=False, **kwargs):
+        """
+        限流后调用接口，被限流时退避重试，重试次数用完后抛出最后一次的异常
+        @param func: 客户端的接口方法
+        @param retry_transient: 服务端错误、连接失败和超时是否重试，只读接口才能重试
+        @return: 接口的返回值
+        """
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            started = self.limiter.acquire()
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttled(e)
+                self.limiter.release(started, False, throttled)
+                if throttled:
+                    self.throttled += 1
+                if attempt >= MAX_RETRIES or not (throttled or retry_transient and is_transient(e)):
+                    raise
+            else:
+                self.limiter.release(started, True)
+                return response
+            attempt += 1
+            time.sleep(backoff(attempt))
+
+
+class ThrottledClient:
+    def __init__(self, client, throttle):
+        """
+        SDK客户端的包装，接口方法经过Throttle调用，其他属性直接访问原客户端
+        @param client: SDK客户端
+        @param throttle: 该客户端所属(服务, 区域)的Throttle
+        """
+        self._client = client
+        self._throttle = throttle
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        return functools.partial(self._throttle.call, attr, retry_transient=name.startswith(READ_PREFIXES))
+
+
+def get_throttle(service, region) -> Throttle:
+    """
+    获取(服务, 区域)的Throttle，同一容器内共享
+    @param service: 服务名，如ecs evs
+    @param region: 区域
+    @return: Throttle
+    """
+    key = (service, region)
+    with _throttles_lock:
+        if key not in _throttles:
+            _throttles[key] = Throttle(SERVICE_RATES.get(service, DEFAULT_RATE))
+        return _throttles[key]
@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+
+from cache import PersistentCache, account_key
+
+import time
+import calendar
+import threading
+from datetime import datetime
+
+"""
+IAM token缓存。token在内存和/tmp中保存到过期前，同一实例上的多次运行、同一次运行中的多个请求共用一个token，
+剩余有效期不足时才重新认证，减少IAM的调用和认证接口的限流。
+"""
+
+TOKEN_TTL = 24 * 3600  # IAM token的最长有效期(秒)
+TOKEN_RENEW_MARGIN = 600  # 剩余有效期少于该值(秒)时提前更新
+
+_token_lock = threading.Lock()
+
+
+def parse_expires_at(value) -> float:
+    """
+    解析token的expires_at，如2026-10-19T08:00:00.000000Z(UTC)
+    @param value: expires_at
+    @return: 时间戳
+    """
+    return calendar.timegm(datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").timetuple())
+
+
+class TokenCache:
+    def __init__(self, renew_margin=TOKEN_RENEW_MARGIN):
+        """
+        @param renew_margin: 提前更新的时间(秒)
+        """
+        self.renew_margin = renew_margin
+        self.cache = PersistentCache("iam_token", TOKEN_TTL)
+
+    def get(self, key, fetch):
+        """
+        获取token，缓存中没有或即将过期时调用fetch重新获取，同时只有一个线程获取
+        @param key: 区分不同用户和项目，如(账号, 用户名, 项目)
+        @param fetch: 获取token的函数，返回(token, expires_at)，失败返回(None, None)
+        @return: token，获取失败返回None
+        """
+        cache_key = account_key("/".join(key))
+        with _token_lock:
+            item = self.cache.get(cache_key)
+            if item and item.get("expires_at") - time.time() > self.renew_margin:
+                return item.get("token")
+            token, expires_at = fetch()
+            if token and expires_at:
+                self.cache.set(cache_key, {"token": token, "expires_at": parse_expires_at(expires_at)})
+            elif item and item.get("expires_at") > time.time():  # 重新获取失败时，未过期的token继续使用
+                return item.get("token")
+            return token